@@ -0,0 +1,138 @@
+from bisect import bisect_right
+from collections import Counter
+import re
+
+DEFAULT_KEYWORDS = (
+    'accessible', 'accessibility', 'inaccessible', 'ramp', 'elevator', 'accessible entrance',
+    'wheelchair', 'accessible restroom', 'lift',
+)
+
+DEFAULT_PLACE_TYPES = (
+    'transit_station', 'shopping_mall', 'hospital', 'airport', 'subway_station', 'train_station',
+    'bus_station', 'public_building',
+)
+
+# weights for the place relevance score: a keyword in the place name says more than one in a review
+NAME_MATCH_WEIGHT = 3.0
+REVIEW_MATCH_WEIGHT = 1.0
+RELEVANT_TYPE_WEIGHT = 0.5
+
+# joins review texts for batch matching; never part of a keyword, so no match can span two reviews
+_SEPARATOR = '\x00'
+
+
+def _normalize(term):
+    return ' '.join(term.lower().split())
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class AccessibilityClassifier:
+    """
+    Finds accessibility keywords in place names and reviews in a single pass per text or batch.
+
+    Keywords match as whole words (so "ramp" does not match "rampant"), case-insensitively, with any
+    run of whitespace between the words of a phrase and an optional plural "s". Longer phrases win
+    over their prefixes, so "accessible entrance" counts once as itself rather than as "accessible".
+
+    Python's regex engine is slow to scan for many alternatives at every position, so the text is
+    first searched for the literal first word of each keyword with str.find, and the precompiled
+    alternation is only tried, anchored, at those candidate positions.
+    """
+    def __init__(self, keywords=DEFAULT_KEYWORDS, place_types=DEFAULT_PLACE_TYPES):
+        self.keywords = tuple(dict.fromkeys(_normalize(keyword) for keyword in keywords if keyword.strip()))
+        self.place_types = frozenset(place_types)
+
+        alternatives = [
+            r'\s+'.join(re.escape(word) for word in keyword.split())
+            for keyword in sorted(self.keywords, key=len, reverse=True)
+        ]
+        self.pattern = re.compile(r'(?:' + '|'.join(alternatives) + r')s?\b')
+        self.anchors = tuple(sorted({keyword.split()[0] for keyword in self.keywords}))
+
+        self._canonical = {}
+        for keyword in self.keywords:
+            self._canonical[keyword] = keyword
+            self._canonical.setdefault(keyword + 's', keyword)
+
+    # (start, term) for every keyword in already lower-cased text, in order and without overlaps
+    def _scan(self, text):
+        candidates = []
+        for anchor in self.anchors:
+            position = text.find(anchor)
+            while position != -1:
+                candidates.append(position)
+                position = text.find(anchor, position + 1)
+        candidates.sort()
+
+        found = []
+        end = -1
+        for position in candidates:
+            if position < end or (position and _is_word_char(text[position - 1])):
+                continue
+            match = self.pattern.match(text, position)
+            if match:
+                found.append((position, self._canonical[_normalize(match.group())]))
+                end = match.end()
+        return found
+
+    def is_relevant(self, text):
+        return bool(text) and bool(self._scan(text.lower()))
+
+    def matches(self, text):
+        if not text:
+            return Counter()
+        return Counter(term for _, term in self._scan(text.lower()))
+
+    def has_relevant_type(self, types):
+        return not self.place_types.isdisjoint(types or ())
+
+    # classify many texts with one scan over their concatenation; one Counter per text
+    def classify_texts(self, texts):
+        # lower-case each text on its own: lower() can change a string's length, which would shift offsets
+        texts = [(text or '').lower() for text in texts]
+        counts = [Counter() for _ in texts]
+        if not texts:
+            return counts
+
+        starts = []
+        offset = 0
+        for text in texts:
+            starts.append(offset)
+            offset += len(text) + len(_SEPARATOR)
+
+        for position, term in self._scan(_SEPARATOR.join(texts)):
+            counts[bisect_right(starts, position) - 1][term] += 1
+        return counts
+
+    def classify_reviews(self, reviews):
+        return self.classify_texts([review.get('text', '') for review in reviews])
+
+    # reviews mentioning at least one keyword, in their original order, and every term they mention
+    def review_matches(self, reviews):
+        relevant = []
+        terms = Counter()
+        for review, counts in zip(reviews, self.classify_reviews(reviews)):
+            if counts:
+                relevant.append(review)
+                terms.update(counts)
+        return relevant, terms
+
+    def relevant_reviews(self, reviews):
+        return self.review_matches(reviews)[0]
+
+    def score_place(self, name_terms, types, review_terms):
+        """
+        Relevance of a place to accessibility, with the terms that contributed and how often, from the
+        terms already found in its name by matches() and in its reviews by review_matches().
+        """
+        score = NAME_MATCH_WEIGHT * sum(name_terms.values()) + REVIEW_MATCH_WEIGHT * sum(review_terms.values())
+        if self.has_relevant_type(types):
+            score += RELEVANT_TYPE_WEIGHT
+
+        return {
+            "score": score,
+            "matched_terms": dict(name_terms + review_terms),
+        }
@@ -1,30 +1,167 @@
-from sqlalchemy.orm import Session, sessionmaker, declarative_base, relationship
-from sqlalchemy import create_engine, Column, Integer, String, Text, UniqueConstraint, ForeignKey
-from sqlalchemy.dialects.mysql import LONGTEXT
+from sqlalchemy.orm import undefer
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, func
+from sqlalchemy.exc import IntegrityError
 from fastapi import FastAPI, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from fastapi import BackgroundTasks
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from sqlalchemy_paginator import Paginator
-import requests
+from database import AsyncSessionLocal, get_db, engine
+from models import User, Route, CachedRoute, normalize_location, utcnow
+from datetime import timedelta
+from collections import Counter
+from cache import PlaceDetailsCache
+from ttl_cache import TTLCache
+from jobs import DatabaseJobStore, MemoryJobStore, WorkerPool, QueueFull
+from geo_index import NearbySearchIndex
+from route_codec import RoutePayload, dumps_compact
+from upstream import GoogleMapsClient, HttpGoogleMapsClient, DEFAULT_BASE_URL, UPSTREAM_ERRORS
+from resilience import SingleFlight, CircuitBreaker
+from planner import EnrichmentPlan, DEFAULT_SPACING, parse_spacing
+from refresh import AccessTracker, RefreshScheduler
+from accessibility import AccessibilityClassifier, DEFAULT_KEYWORDS, DEFAULT_PLACE_TYPES
+from metrics import (
+    registry, stage, instrument_engine, current_endpoint, METRICS_ENABLED, HTTP_REQUEST_SECONDS,
+    ENRICHMENT_PROBE_SECONDS, ENRICHMENT_REQUEST_SECONDS, ENRICHMENT_PROBES, ROUTE_CACHE_LOOKUPS
+)
+from starlette.routing import Match
+import asyncio
 import json
+import base64
 import os
 from dotenv import load_dotenv
 import logging
 import time
 import uvicorn
+from contextlib import asynccontextmanager
 
 load_dotenv()
 
 GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
-DATABASE_URL = os.getenv('DATABASE_URL')
-
-Base = declarative_base()
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
 
-app = FastAPI()
+# how long a shared, enriched route stays fresh before it is fetched again
+ROUTE_CACHE_TTL = int(os.getenv('ROUTE_CACHE_TTL', '86400'))
+# an expired route is still served for this long while it is recomputed in the background
+ROUTE_STALE_WHILE_REVALIDATE = int(os.getenv('ROUTE_STALE_WHILE_REVALIDATE', '3600'))
+# recently used route payloads kept in memory, so a hit doesn't read the payload from the database
+ROUTE_MEMORY_CACHE_SIZE = int(os.getenv('ROUTE_MEMORY_CACHE_SIZE', '1000'))
+
+# storage encoding for cached route payloads (zlib, or zstd when the zstandard package is installed)
+ROUTE_CODEC = os.getenv('ROUTE_CODEC', 'zlib')
+ROUTE_CODEC_LEVEL = int(os.getenv('ROUTE_CODEC_LEVEL', '6'))
+
+# upstream fan-out tuning
+ENRICHMENT_CONCURRENCY = int(os.getenv('ENRICHMENT_CONCURRENCY', '20'))
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '50'))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', '20'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '10'))
+# point at fake_google.py (or a recording proxy) to run without the real Google APIs
+GOOGLE_MAPS_BASE_URL = os.getenv('GOOGLE_MAPS_BASE_URL', DEFAULT_BASE_URL)
+
+# enrichment probes: metres between probes along a route per travel mode (e.g. "walking:150,driving:800"),
+# the search radius around each probe, and the most probes searched for one directions response
+ENRICHMENT_SPACING = {**DEFAULT_SPACING, **parse_spacing(os.getenv('ENRICHMENT_SPACING', ''))}
+ENRICHMENT_RADIUS = int(os.getenv('ENRICHMENT_RADIUS', '200'))
+# probes closer than this to one already planned are dropped; defaults to half the radius
+ENRICHMENT_MERGE_DISTANCE = float(os.getenv('ENRICHMENT_MERGE_DISTANCE', str(ENRICHMENT_RADIUS / 2)))
+ENRICHMENT_MAX_PROBES = int(os.getenv('ENRICHMENT_MAX_PROBES', '80'))
+
+# per-API rate limits in calls per second and daily call budgets; 0 means unlimited
+DIRECTIONS_RATE_LIMIT = float(os.getenv('DIRECTIONS_RATE_LIMIT', '50'))
+NEARBY_RATE_LIMIT = float(os.getenv('NEARBY_RATE_LIMIT', '50'))
+DETAILS_RATE_LIMIT = float(os.getenv('DETAILS_RATE_LIMIT', '50'))
+DIRECTIONS_DAILY_QUOTA = int(os.getenv('DIRECTIONS_DAILY_QUOTA', '0'))
+NEARBY_DAILY_QUOTA = int(os.getenv('NEARBY_DAILY_QUOTA', '0'))
+DETAILS_DAILY_QUOTA = int(os.getenv('DETAILS_DAILY_QUOTA', '0'))
+# longest a call may wait for its rate limit before it is given up
+UPSTREAM_RATE_LIMIT_WAIT = float(os.getenv('UPSTREAM_RATE_LIMIT_WAIT', '10'))
+
+# retries for 5xx, timeouts and OVER_QUERY_LIMIT, and the per-API circuit breaker
+UPSTREAM_RETRIES = int(os.getenv('UPSTREAM_RETRIES', '2'))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv('UPSTREAM_RETRY_BACKOFF', '0.2'))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+
+# routes enriched while some place lookups failed are cached this briefly, so they are soon redone
+DEGRADED_ROUTE_TTL = int(os.getenv('DEGRADED_ROUTE_TTL', '300'))
+
+# place details cache tuning; the database tier is opt-in
+PLACE_CACHE_SIZE = int(os.getenv('PLACE_CACHE_SIZE', '10000'))
+PLACE_CACHE_TTL = int(os.getenv('PLACE_CACHE_TTL', '604800'))
+PLACE_CACHE_NEGATIVE_TTL = int(os.getenv('PLACE_CACHE_NEGATIVE_TTL', '300'))
+PLACE_CACHE_DB = os.getenv('PLACE_CACHE_DB', 'false').lower() in ('1', 'true', 'yes')
+# database sessions the place details tier may have open at once; keep it well below DB_POOL_SIZE
+PLACE_CACHE_DB_CONCURRENCY = int(os.getenv('PLACE_CACHE_DB_CONCURRENCY', '4'))
+
+# nearby search results are reused for any query inside an already searched grid cell
+NEARBY_INDEX_CELL_SIZE = int(os.getenv('NEARBY_INDEX_CELL_SIZE', '50'))
+NEARBY_INDEX_MAX_CELLS = int(os.getenv('NEARBY_INDEX_MAX_CELLS', '100000'))
+NEARBY_INDEX_TTL = int(os.getenv('NEARBY_INDEX_TTL', '86400'))
+
+# keywords and place types that make a place worth reporting; comma-separated overrides
+ACCESSIBILITY_KEYWORDS = [k for k in os.getenv('ACCESSIBILITY_KEYWORDS', '').split(',') if k.strip()] or DEFAULT_KEYWORDS
+ACCESSIBILITY_PLACE_TYPES = [t.strip() for t in os.getenv('ACCESSIBILITY_PLACE_TYPES', '').split(',') if t.strip()] \
+    or DEFAULT_PLACE_TYPES
+
+# only request the place details fields we use; reviews are billed separately from basic data
+PLACE_DETAILS_FIELDS = "rating,user_ratings_total,reviews"
+
+
+# history listings: page size bounds and how long a user's route count may be served from memory
+HISTORY_MAX_LIMIT = int(os.getenv('HISTORY_MAX_LIMIT', '100'))
+VIEWED_COUNT_TTL = int(os.getenv('VIEWED_COUNT_TTL', '60'))
+
+# /routes/batch limits
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '1000'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '8'))
+
+# /routes/async job processing; JOB_WORKERS=0 makes this process accept jobs without running them
+JOB_STORE = os.getenv('JOB_STORE', 'database')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_QUEUE_LIMIT = int(os.getenv('JOB_QUEUE_LIMIT', '1000'))
+JOB_RESULT_TTL = int(os.getenv('JOB_RESULT_TTL', '3600'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+JOB_STALE_AFTER = int(os.getenv('JOB_STALE_AFTER', '600'))
+
+# popularity-driven refresh and eviction of the shared caches (see refresh.py). With several service
+# processes, set REFRESH_SCHEDULER=false and run `python refresh.py` once; access is still recorded
+REFRESH_SCHEDULER = os.getenv('REFRESH_SCHEDULER', 'true').lower() in ('1', 'true', 'yes')
+REFRESH_INTERVAL = float(os.getenv('REFRESH_INTERVAL', '60'))
+REFRESH_AHEAD = int(os.getenv('REFRESH_AHEAD', '600'))
+REFRESH_HOT_WINDOW = int(os.getenv('REFRESH_HOT_WINDOW', '86400'))
+REFRESH_MIN_HITS = int(os.getenv('REFRESH_MIN_HITS', '3'))
+REFRESH_BATCH_SIZE = int(os.getenv('REFRESH_BATCH_SIZE', '50'))
+REFRESH_CONCURRENCY = int(os.getenv('REFRESH_CONCURRENCY', '4'))
+ACCESS_FLUSH_INTERVAL = float(os.getenv('ACCESS_FLUSH_INTERVAL', '10'))
+# expired entries unused for this long are deleted; routes still in someone's history are kept
+CACHE_EVICT_AFTER = int(os.getenv('CACHE_EVICT_AFTER', '2592000'))
+CACHE_EVICT_INTERVAL = float(os.getenv('CACHE_EVICT_INTERVAL', '3600'))
+# at startup, the most used entries are loaded into memory within these bounds; 0 seconds disables it
+WARMUP_MAX_SECONDS = float(os.getenv('WARMUP_MAX_SECONDS', '10'))
+WARMUP_MAX_BYTES = int(os.getenv('WARMUP_MAX_BYTES', str(64 * 1024 * 1024)))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if JOB_WORKERS > 0:
+        await job_pool.start()
+    await access_tracker.start()
+    scheduler = create_refresh_scheduler()
+    if REFRESH_SCHEDULER:
+        await scheduler.start()
+    warm_up = asyncio.create_task(scheduler.warm_up(WARMUP_MAX_SECONDS, WARMUP_MAX_BYTES)) \
+        if WARMUP_MAX_SECONDS > 0 else None
+    yield
+    if warm_up is not None:
+        warm_up.cancel()
+        await asyncio.gather(warm_up, return_exceptions=True)
+    await scheduler.stop()
+    await job_pool.stop()
+    await access_tracker.stop()
+    await close_google_client()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 origins = ["http://127.0.0.1:5500"]
@@ -40,173 +177,759 @@ GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# httpx logs every request URL at INFO, which would leak the API key into the logs
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
-class User(Base):
-    __tablename__ = 'user'
-    id = Column(String(50), primary_key=True)
-    routes = relationship('Route', back_populates='user')
+# to create the schema: python -c "import asyncio, database, models; asyncio.run(database.create_tables())"
 
-class Route(Base):
-    __tablename__ = 'route'
-    id = Column(Integer, primary_key=True)
-    origin = Column(String(256), nullable=False)
-    destination = Column(String(256), nullable=False)
-    mode = Column(String(50), nullable=False)
-    route_data = Column(LONGTEXT, nullable=False)
-    user_id = Column(String(50), ForeignKey('user.id'), nullable=False)
+classifier = AccessibilityClassifier(keywords=ACCESSIBILITY_KEYWORDS, place_types=ACCESSIBILITY_PLACE_TYPES)
 
-    user = relationship('User', back_populates='routes')
+place_details_cache = PlaceDetailsCache(
+    maxsize=PLACE_CACHE_SIZE,
+    ttl=PLACE_CACHE_TTL,
+    negative_ttl=PLACE_CACHE_NEGATIVE_TTL,
+    session_factory=AsyncSessionLocal if PLACE_CACHE_DB else None,
+    db_concurrency=PLACE_CACHE_DB_CONCURRENCY
+)
 
-    __table_args__ = (UniqueConstraint('origin', 'destination', 'mode', 'user_id', name='_origin_destination_user_uc'),)
+nearby_index = NearbySearchIndex(
+    cell_size=NEARBY_INDEX_CELL_SIZE,
+    max_cells=NEARBY_INDEX_MAX_CELLS,
+    ttl=NEARBY_INDEX_TTL
+)
 
-# Base.metadata.drop_all(bind=engine)
-# Base.metadata.create_all(bind=engine)
+viewed_count_cache = TTLCache(maxsize=10000, ttl=VIEWED_COUNT_TTL)
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# (origin key, destination key, mode) -> detached CachedRoute holding id, expiry and payload
+route_memory_cache = TTLCache(maxsize=ROUTE_MEMORY_CACHE_SIZE, ttl=ROUTE_CACHE_TTL)
 
+access_tracker = AccessTracker(AsyncSessionLocal, track_places=PLACE_CACHE_DB, flush_interval=ACCESS_FLUSH_INTERVAL)
 
-# call google places API to check for accessible facilities near given location
-def find_accessible_places(lat, lng, radius=200):
-    places_url = (
-        f"https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-        f"?location={lat},{lng}&radius={radius}&key={GOOGLE_MAPS_API_KEY}"
-    )
+instrument_engine(engine)
+
+
+# hits and misses of the in-process caches, read when /metrics is scraped
+def cache_lookups():
+    return {
+        'route': (route_memory_cache.hits, route_memory_cache.misses),
+        'place_details': (place_details_cache.memory.hits, place_details_cache.memory.misses),
+        'nearby_search': (nearby_index.hits, nearby_index.misses),
+        'viewed_count': (viewed_count_cache.hits, viewed_count_cache.misses),
+    }
+
+
+registry.counter('cache_hits', "Lookups answered by an in-process cache", ('cache',),
+               collect=lambda: {(name,): hits for name, (hits, _) in cache_lookups().items()})
+registry.counter('cache_misses', "Lookups an in-process cache could not answer", ('cache',),
+               collect=lambda: {(name,): misses for name, (_, misses) in cache_lookups().items()})
+registry.gauge('cache_hit_ratio', "Share of lookups answered by an in-process cache since startup", ('cache',),
+               collect=lambda: {(name,): hits / (hits + misses) if hits + misses else 0.0
+                                for name, (hits, misses) in cache_lookups().items()})
+
+# shared client for all google maps calls; keeps connections alive between requests
+_google_client = None
+
+
+def get_google_client() -> GoogleMapsClient:
+    global _google_client
+    if _google_client is None:
+        _google_client = HttpGoogleMapsClient(
+            GOOGLE_MAPS_API_KEY,
+            base_url=GOOGLE_MAPS_BASE_URL,
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive=HTTP_MAX_KEEPALIVE,
+            timeout=HTTP_TIMEOUT,
+            rate_limits={
+                'directions': DIRECTIONS_RATE_LIMIT,
+                'nearbysearch': NEARBY_RATE_LIMIT,
+                'details': DETAILS_RATE_LIMIT,
+            },
+            daily_quotas={
+                'directions': DIRECTIONS_DAILY_QUOTA,
+                'nearbysearch': NEARBY_DAILY_QUOTA,
+                'details': DETAILS_DAILY_QUOTA,
+            },
+            max_wait=UPSTREAM_RATE_LIMIT_WAIT,
+            retries=UPSTREAM_RETRIES,
+            backoff=UPSTREAM_RETRY_BACKOFF,
+            failure_threshold=BREAKER_FAILURE_THRESHOLD,
+            reset_timeout=BREAKER_RESET_TIMEOUT,
+        )
+    return _google_client
+
+
+# swap in another upstream implementation, e.g. a fake for tests and benchmarks
+def set_google_client(client: GoogleMapsClient):
+    global _google_client
+    _google_client = client
+
+
+async def close_google_client():
+    global _google_client
+    if _google_client is not None:
+        await _google_client.aclose()
+        _google_client = None
+
+
+class EnrichmentContext:
+    """
+    Per-request state shared by every upstream call made while enriching a set of routes.
 
+    `upstream_failures` counts place lookups that failed for want of a usable Google response, and
+    `degraded` says why the routes returned are not a complete, fresh result: 'stale' (an expired
+    cached copy), 'partial' (some place lookups failed) or 'unavailable' (no routes could be had).
+    """
+    def __init__(self, concurrency=None, semaphore=None, place_details=None):
+        self.semaphore = semaphore or asyncio.Semaphore(concurrency or ENRICHMENT_CONCURRENCY)
+        self.place_details = {} if place_details is None else place_details
+        self.upstream_failures = 0
+        self.degraded = None
+
+    # a context for one trip that shares this one's concurrency limit and place lookups
+    def for_trip(self):
+        return EnrichmentContext(semaphore=self.semaphore, place_details=self.place_details)
+
+
+def record_upstream_failure(ctx: EnrichmentContext = None):
+    if ctx is not None:
+        ctx.upstream_failures += 1
+
+
+def upstream_limiter(ctx: EnrichmentContext = None):
+    return ctx.semaphore if ctx is not None else None
+
+
+# call google places nearby search API; None when google answered with an error status
+async def fetch_nearby_places(lat, lng, radius, ctx: EnrichmentContext = None):
+    data = await get_google_client().nearby_search(lat, lng, radius, upstream_limiter(ctx))
+    if data.get('status', 'OK') not in ('OK', 'ZERO_RESULTS'):
+        logger.warning(f"Error fetching places: {data.get('status')}")
+        return None
+    return data.get('results', [])
+
+
+# call google places API to check for accessible facilities near given location
+async def find_accessible_places(lat, lng, radius=200, ctx: EnrichmentContext = None):
     try:
-        response = requests.get(places_url)
-        places = response.json().get('results', [])
+        # answered from the spatial index when an earlier search already covers this point
+        places = await nearby_index.search(
+            lat, lng, radius, lambda lat, lng, radius: fetch_nearby_places(lat, lng, radius, ctx))
+        if places is None:
+            return None
 
-        accessibility_keywords = ['accessible', 'accessibility', 'ramp', 'elevator', 'accessible entrance',
-                                  'wheelchair', 'accessible restroom', 'lift']
-        relevant_types = ['transit_station', 'shopping_mall', 'hospital', 'airport', 'subway_station', 'train_station',
-                          'bus_station', 'public_building']
+        candidates = []
+        for place in places:
+            name_terms = classifier.matches(place.get('name', ''))
+            if name_terms:
+                candidates.append((place, name_terms, False))
+            elif classifier.has_relevant_type(place.get('types')):
+                candidates.append((place, name_terms, True))
+
+        # fetch details for every candidate at once instead of one place at a time
+        details = await asyncio.gather(*(get_place_details(place['place_id'], ctx) for place, _, _ in candidates))
 
         accessible_places = []
-        for place in places:
-            if any(keyword in place.get('name', '').lower() for keyword in accessibility_keywords):
-                place_details = get_place_details(place['place_id'])
-                accessible_places.append({
-                    "name": place.get('name'),
-                    "location": place.get('geometry', {}).get('location'),
-                    "place_id": place.get('place_id'),
-                    "details": place_details
-                })
-            elif any(t in place.get('types', []) for t in relevant_types):
-                place_details = get_place_details(place['place_id'])
-                if len(place_details['relevant_reviews']) > 0:
-                    accessible_places.append({
-                        "name": place.get('name'),
-                        "location": place.get('geometry', {}).get('location'),
-                        "place_id": place.get('place_id'),
-                        "details": place_details
-                    })
+        for (place, name_terms, needs_reviews), place_details in zip(candidates, details):
+            if needs_reviews and not place_details.get('relevant_reviews'):
+                continue
+            place_details = dict(place_details)
+            review_terms = Counter(place_details.pop('review_terms', {}))
+            accessible_places.append({
+                "name": place.get('name'),
+                "location": place.get('geometry', {}).get('location'),
+                "place_id": place.get('place_id'),
+                "details": place_details,
+                "accessibility": classifier.score_place(name_terms, place.get('types'), review_terms)
+            })
 
         return accessible_places
 
-    except requests.RequestException as e:
-        print(f"Error fetching places: {e}")
+    except UPSTREAM_ERRORS as e:
+        logger.warning(f"Error fetching places: {e}")
+        record_upstream_failure(ctx)
         return None
 
 
-# get detailed info about a place using google place details API
-def get_place_details(place_id):
-    place_details_url = (
-        f"https://maps.googleapis.com/maps/api/place/details/json"
-        f"?place_id={place_id}&key={GOOGLE_MAPS_API_KEY}"
-    )
+# fetch the fields we use from google place details API; None when google answered with an error
+# status (remembered for a while), an exception when there was no usable answer (retried next time)
+async def fetch_place_details(place_id, ctx: EnrichmentContext = None):
+    data = await get_google_client().place_details(place_id, PLACE_DETAILS_FIELDS, upstream_limiter(ctx))
+    if data.get('status', 'OK') != 'OK':
+        logger.warning(f"Error fetching place details: {data.get('status')}")
+        return None
 
+    return classify_place_details(data.get('result', {}))
+
+
+# reviews are classified once, when fetched, and only the relevant ones are cached along with the
+# terms they mention
+def classify_place_details(place_details):
+    relevant_reviews, review_terms = classifier.review_matches(place_details.get('reviews', []))
+    return {
+        "rating": place_details.get("rating"),
+        "user_ratings_total": place_details.get("user_ratings_total"),
+        "relevant_reviews": relevant_reviews,
+        "review_terms": dict(review_terms)
+    }
+
+
+# get detailed info about a place using google place details API
+async def get_place_details(place_id, ctx: EnrichmentContext = None):
     try:
-        response = requests.get(place_details_url)
-        place_details = response.json().get('result', {})
-        accessibility_keywords = ['accessible', 'accessibility', 'ramp', 'elevator', 'accessible entrance',
-                                  'wheelchair', 'accessible restroom', 'lift']
-
-        reviews = place_details.get('reviews', [])
-        relevant_reviews = [review for review in reviews if
-                            any(keyword in review.get('text', '').lower() for keyword in accessibility_keywords)]
-
-        return {
-            "rating": place_details.get("rating"),
-            "user_ratings_total": place_details.get("user_ratings_total"),
-            "relevant_reviews": relevant_reviews
-        }
+        if ctx is None:
+            access_tracker.place_accessed(place_id)
+            place_details = await place_details_cache.get_or_fetch(place_id, fetch_place_details)
+        else:
+            # each place_id is fetched at most once per route computation, however many steps find it
+            task = ctx.place_details.get(place_id)
+            if task is None:
+                access_tracker.place_accessed(place_id)
+                task = asyncio.ensure_future(place_details_cache.get_or_fetch(
+                    place_id, lambda place_id: fetch_place_details(place_id, ctx)))
+                ctx.place_details[place_id] = task
+            place_details = await task
+    except UPSTREAM_ERRORS as e:
+        logger.warning(f"Error fetching place details: {e}")
+        record_upstream_failure(ctx)
+        return {}
 
-    except requests.RequestException as e:
-        print(f"Error fetching place details: {e}")
+    if place_details is None:
         return {}
 
+    # rows stored in the place_details table before reviews were classified on fetch hold them raw
+    if 'reviews' in place_details:
+        return classify_place_details(place_details)
+    return place_details
 
-# get routes from google directions API and check for accessibility along the way
-def get_accessible_routes(db: Session, origin, destination, mode="walking", user_id=None):
-    user = db.query(User).filter_by(id=user_id).first()
-    if not user:
-        new_user = User(id=user_id)
-        db.add(new_user)
-        db.commit()
 
-    existing_route = db.query(Route).filter_by(
+def plan_enrichment(routes, mode):
+    plan = EnrichmentPlan(
+        routes,
+        spacing=ENRICHMENT_SPACING.get(mode.lower(), ENRICHMENT_SPACING['walking']),
+        radius=ENRICHMENT_RADIUS,
+        merge_distance=ENRICHMENT_MERGE_DISTANCE,
+        max_probes=ENRICHMENT_MAX_PROBES
+    )
+    ENRICHMENT_PROBES.observe(len(plan.probes))
+    return plan
+
+
+async def search_probe(lat, lng, ctx: EnrichmentContext):
+    with ENRICHMENT_PROBE_SECONDS.time():
+        return await find_accessible_places(lat, lng, ENRICHMENT_RADIUS, ctx)
+
+
+# search around every probe point of the routes concurrently, bounded by the context's concurrency limit,
+# and attach what is found to the steps it is closest to. With `on_step`, on_step((route, leg, step),
+# accessible_places) is also called as each probe finishes, for every step that gained places
+async def enrich_routes(routes, ctx: EnrichmentContext = None, mode="walking", on_step=None):
+    ctx = ctx or EnrichmentContext()
+    plan = plan_enrichment(routes, mode)
+    with ENRICHMENT_REQUEST_SECONDS.time():
+        if on_step is None:
+            results = await asyncio.gather(*(search_probe(lat, lng, ctx) for lat, lng in plan.probes))
+        else:
+            results = await search_probes_reporting(plan, ctx, on_step)
+    # assigned in probe order, so the places on each step come out in the same order every time
+    for places in results:
+        if places:
+            plan.assign(places)
+    return routes
+
+
+# search every probe like enrich_routes, reporting each step's places as they are found; the routes
+# themselves are left alone, since places found this way come in completion order
+async def search_probes_reporting(plan, ctx: EnrichmentContext, on_step):
+    async def probe(index, lat, lng):
+        return index, await search_probe(lat, lng, ctx)
+
+    results = [None] * len(plan.probes)
+    found = {}
+    tasks = [asyncio.ensure_future(probe(index, lat, lng)) for index, (lat, lng) in enumerate(plan.probes)]
+    try:
+        for done in asyncio.as_completed(tasks):
+            index, places = await done
+            results[index] = places
+            changed = set()
+            for position, _, place in plan.locate(places or []):
+                step_places = found.setdefault(position, {})
+                if place.get('place_id') not in step_places:
+                    step_places[place.get('place_id')] = place
+                    changed.add(position)
+            for position in sorted(changed):
+                on_step(position, list(found[position].values()))
+    finally:
+        for task in tasks:
+            task.cancel()
+    return results
+
+
+# look up the shared cache entry for a trip, regardless of which user cached it
+async def get_cached_route(db: AsyncSession, origin, destination, mode, with_payload=True):
+    query = select(CachedRoute).filter_by(
+        origin_key=normalize_location(origin),
+        destination_key=normalize_location(destination),
+        mode=mode.lower()
+    )
+    if with_payload:
+        query = query.options(undefer(CachedRoute.route_blob), undefer(CachedRoute.route_data))
+    result = await db.execute(query)
+    return result.scalars().first()
+
+
+# insert or refresh the shared cache entry; concurrent writers for the same trip converge on one row
+async def store_cached_route(db: AsyncSession, origin, destination, mode, payload: RoutePayload, ttl=None,
+                             degraded=None):
+    now = utcnow()
+    expires_at = now + timedelta(seconds=ROUTE_CACHE_TTL if ttl is None else ttl)
+    route_blob = payload.blob(ROUTE_CODEC, ROUTE_CODEC_LEVEL)
+
+    cached_route = await get_cached_route(db, origin, destination, mode, with_payload=False)
+    if cached_route is None:
+        cached_route = CachedRoute(
+            origin_key=normalize_location(origin),
+            destination_key=normalize_location(destination),
+            mode=mode.lower(),
+            route_blob=route_blob,
+            created_at=now,
+            expires_at=expires_at,
+            degraded=degraded
+        )
+        db.add(cached_route)
+        try:
+            await db.commit()
+            return cached_route
+        except IntegrityError:
+            await db.rollback()
+            cached_route = await get_cached_route(db, origin, destination, mode, with_payload=False)
+
+    cached_route.route_blob = route_blob
+    cached_route.route_data = None
+    cached_route.created_at = now
+    cached_route.expires_at = expires_at
+    cached_route.degraded = degraded
+    await db.commit()
+    return cached_route
+
+
+# keep a copy of a fresh cache entry in memory until it expires
+def remember_route(key, route_id, expires_at, blob=None, text=None, degraded=None):
+    ttl = (expires_at - utcnow()).total_seconds()
+    if ttl > 0:
+        route_memory_cache.set(key, CachedRoute(id=route_id, expires_at=expires_at, degraded=degraded, route_blob=blob,
+                                                route_data=text), ttl=ttl)
+
+
+# look in memory first, then in the database, which another process may have refreshed; the entry
+# found may be expired
+async def lookup_cached_route(db: AsyncSession, origin, destination, mode):
+    key = batch_key(origin, destination, mode)
+    cached_route = route_memory_cache.get(key)
+    if cached_route is None or cached_route.expires_at <= utcnow():
+        cached_route = await get_cached_route(db, origin, destination, mode)
+        if cached_route is not None:
+            remember_route(key, cached_route.id, cached_route.expires_at, cached_route.route_blob,
+                           cached_route.route_data if cached_route.route_blob is None else None, cached_route.degraded)
+    return cached_route
+
+
+# record_viewed_route in a short-lived session of its own, for callers that have waited on google or on
+# a client since their last query and must not have held a connection meanwhile
+async def record_view(cached_route: CachedRoute, origin, destination, mode, user_id):
+    async with AsyncSessionLocal() as db:
+        await record_viewed_route(db, cached_route, origin, destination, mode, user_id)
+
+
+# add the trip to the user's viewed routes, pointing at the shared cache entry
+async def record_viewed_route(db: AsyncSession, cached_route: CachedRoute, origin, destination, mode, user_id):
+    result = await db.execute(select(Route).filter_by(
         origin=origin,
         destination=destination,
         mode=mode,
         user_id=user_id
-    ).first()
-    
-    if existing_route:
-        return json.loads(existing_route.route_data)
-
-    directions_url = (
-        f"https://maps.googleapis.com/maps/api/directions/json?"
-        f"origin={origin}&destination={destination}&mode={mode}&alternatives=true&key={GOOGLE_MAPS_API_KEY}"
-    )
+    ))
+    viewed_route = result.scalars().first()
+
+    if viewed_route is None:
+        db.add(Route(
+            origin=origin,
+            destination=destination,
+            mode=mode,
+            user_id=user_id,
+            route_cache_id=cached_route.id
+        ))
+        viewed_count_cache.pop(user_id)
+    elif viewed_route.route_cache_id != cached_route.id:
+        viewed_route.route_cache_id = cached_route.id
+    else:
+        return
+
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+
+
+async def ensure_user(db: AsyncSession, user_id):
+    user = await db.get(User, user_id)
+    if not user:
+        new_user = User(id=user_id)
+        db.add(new_user)
+        try:
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+
+
+# get the raw route alternatives from google directions API
+async def fetch_directions(origin, destination, mode):
+    data = await get_google_client().directions(origin, destination, mode)
+    return data.get('routes', [])
+
+
+route_flights = SingleFlight()
+
+BREAKER_STATE_VALUES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+registry.counter('coalesced_requests', "Lookups that waited on an identical one already in flight", ('kind',),
+                 collect=lambda: {
+                     ('route',): route_flights.coalesced,
+                     ('nearby_search',): nearby_index.flights.coalesced,
+                     ('place_details',): place_details_cache.flights.coalesced,
+                 })
+registry.gauge('upstream_circuit_state', "Circuit breaker per Google API: 0 closed, 1 half-open, 2 open", ('api',),
+               collect=lambda: {(api,): BREAKER_STATE_VALUES[breaker.state]
+                                for api, breaker in getattr(get_google_client(), 'breakers', {}).items()})
+registry.gauge('upstream_daily_quota_remaining', "Calls left in today's budget per Google API", ('api',),
+               collect=lambda: {(api,): bucket.remaining_today()
+                                for api, bucket in getattr(get_google_client(), 'buckets', {}).items()
+                                if bucket.daily_quota})
+
+
+# fetch and enrich one trip and store it in the shared cache, with its own session since the requests
+# waiting on it may come and go. Returns (payload, cached route, degraded reason); the payload is None
+# when there is nothing to return. `stale` is the expired cache entry for the trip, if any, and is
+# served instead when google can't give a complete answer. `on_event`, when given, is called with a
+# stream event for the raw directions result and for each step that gains places; it must serialize
+# the event right away, since the routes go on changing.
+async def compute_route_payload(origin, destination, mode, ctx: EnrichmentContext, stale=None, on_event=None):
+    try:
+        with stage('directions'):
+            routes = await fetch_directions(origin, destination, mode)
+    except UPSTREAM_ERRORS as e:
+        logger.warning(f"Error fetching directions: {e}")
+        if stale is not None:
+            return stale.payload, stale, 'stale'
+        return None, None, 'unavailable'
 
+    if not routes:
+        return None, None, None
+
+    on_step = None
+    if on_event is not None:
+        on_event({"type": "routes", "routes": routes, "enriched": False})
+        on_step = lambda position, places: on_event({
+            "type": "step", "route": position[0], "leg": position[1], "step": position[2], "accessible_places": places
+        })
+
+    trip_ctx = ctx.for_trip()
+    with stage('enrich'):
+        await enrich_routes(routes, trip_ctx, mode, on_step)
+
+    degraded = None
+    if trip_ctx.upstream_failures:
+        # an expired complete copy beats a fresh incomplete one; an expired incomplete one doesn't
+        if stale is not None and not stale.degraded:
+            return stale.payload, stale, 'stale'
+        degraded = 'partial'
+
+    # cache the enriched result so hits and misses return the same payload
+    with stage('encode'):
+        payload = RoutePayload.from_routes(routes)
+    async with AsyncSessionLocal() as db:
+        with stage('store'):
+            cached_route = await store_cached_route(
+                db, origin, destination, mode, payload, ttl=DEGRADED_ROUTE_TTL if degraded else None, degraded=degraded)
+    remember_route(batch_key(origin, destination, mode), cached_route.id, cached_route.expires_at,
+                   payload.blob(ROUTE_CODEC, ROUTE_CODEC_LEVEL), degraded=degraded)
+    return payload, cached_route, degraded
+
+
+# 'hit' when fresh, 'stale' when expired but recent enough to serve while it is recomputed
+def route_cache_result(cached_route):
+    if cached_route is None:
+        return 'miss'
+    now = utcnow()
+    if cached_route.expires_at > now:
+        return 'hit'
+    if cached_route.expires_at + timedelta(seconds=ROUTE_STALE_WHILE_REVALIDATE) > now:
+        return 'stale'
+    return 'expired'
+
+
+# recompute a trip without anyone waiting on it; requests for the trip meanwhile join the computation
+background_refreshes = set()
+
+
+async def _revalidate_route(origin, destination, mode, stale):
     try:
-        response = requests.get(directions_url)
-        routes = response.json().get('routes', [])
-
-        if routes:
-            new_route = Route(
-                origin=origin,
-                destination=destination,
-                mode=mode,
-                route_data=json.dumps(routes),
-                user_id=user_id
-            )
-            db.add(new_route)
-            db.commit()
-
-            for route in routes:
-                for leg in route.get('legs', []):
-                    for step in leg.get('steps', []):
-                        lat = step['end_location']['lat']
-                        lng = step['end_location']['lng']
-
-                        # Find accessible places near each step
-                        accessible_places = find_accessible_places(lat, lng)
-                        if accessible_places:
-                            step['accessible_places'] = accessible_places  # add accessible places to step
-
-        return routes
-
-    except requests.RequestException as e:
-        print(f"Error fetching directions: {e}")
+        await route_flights.do(
+            batch_key(origin, destination, mode),
+            lambda: compute_route_payload(origin, destination, mode, EnrichmentContext(), stale=stale))
+    except Exception:
+        logger.exception("Error refreshing route")
+
+
+def revalidate_route(origin, destination, mode, stale):
+    task = asyncio.ensure_future(_revalidate_route(origin, destination, mode, stale))
+    background_refreshes.add(task)
+    task.add_done_callback(background_refreshes.discard)
+
+
+# get routes from google directions API and check for accessibility along the way; the result is
+# returned still encoded so callers that only forward it never parse it
+async def get_accessible_routes_payload(db: AsyncSession, origin, destination, mode="walking", user_id=None,
+                                        ctx: EnrichmentContext = None):
+    with stage('ensure_user'):
+        await ensure_user(db, user_id)
+
+    with stage('cache_lookup'):
+        cached_route = await lookup_cached_route(db, origin, destination, mode)
+    result = route_cache_result(cached_route)
+    ROUTE_CACHE_LOOKUPS.inc(result=result)
+
+    if result in ('hit', 'stale'):
+        if result == 'stale':
+            revalidate_route(origin, destination, mode, cached_route)
+        access_tracker.route_accessed(cached_route.id)
+        # a cached incomplete result is still reported as one to everyone it is served to
+        if ctx is not None:
+            ctx.degraded = cached_route.degraded
+        with stage('decode'):
+            payload = cached_route.payload
+        with stage('record_view'):
+            await record_viewed_route(db, cached_route, origin, destination, mode, user_id)
+        return payload
+
+    # end the read transaction so its pooled connection isn't held, idle, while google is called
+    await db.commit()
+
+    # everyone asking for the same trip while it is being computed waits for that one computation
+    ctx = ctx if ctx is not None else EnrichmentContext()
+    payload, cached_route, ctx.degraded = await route_flights.do(
+        batch_key(origin, destination, mode),
+        lambda: compute_route_payload(origin, destination, mode, ctx, stale=cached_route))
+    if payload is None:
         return None
 
-def process_route_async(task_id: str, origin: str, destination: str, mode: str, user_id: str, db: Session):
+    access_tracker.route_accessed(cached_route.id)
+    with stage('record_view'):
+        await record_view(cached_route, origin, destination, mode, user_id)
+    return payload
+
+
+async def get_accessible_routes(db: AsyncSession, origin, destination, mode="walking", user_id=None,
+                                ctx: EnrichmentContext = None):
+    payload = await get_accessible_routes_payload(db, origin, destination, mode, user_id, ctx)
+    return payload.routes() if payload is not None else None
+
+
+# {"routes": ..., "_links": ...} built around the stored JSON bytes instead of re-serializing the routes;
+# a degraded result says so in a "degraded" field
+def routes_response(payload: RoutePayload, links, status_code=200, headers=None, degraded=None):
+    body = b'{"routes":' + payload.json_bytes() + b',"_links":' + dumps_compact(links)
+    if degraded:
+        body += b',"degraded":' + dumps_compact(degraded)
+    return Response(content=body + b'}', media_type="application/json", status_code=status_code, headers=headers)
+
+
+def routes_error_response(ctx: EnrichmentContext):
+    if ctx.degraded == 'unavailable':
+        return JSONResponse(
+            content={"error": "Route service temporarily unavailable."},
+            status_code=503,
+            headers={"Retry-After": str(max(1, round(BREAKER_RESET_TIMEOUT)))}
+        )
+    return JSONResponse(content={"error": "Error retrieving routes."}, status_code=500)
+
+
+def format_stream_event(event, stream_format):
+    if stream_format == 'sse':
+        return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    return json.dumps(event) + "\n"
+
+
+# same work as get_accessible_routes, but yields the raw routes as soon as directions returns and then
+# one patch per enriched step, so clients can render before enrichment finishes
+async def stream_accessible_routes(origin, destination, mode, user_id, stream_format):
+    links = {
+        "self": f"/routes?origin={origin}&destination={destination}&mode={mode}&user_id={user_id}",
+        "viewed_routes": f"/viewed_routes/page/1?user_id={user_id}&limit=10",
+    }
+
+    # the request's session is closed before a streamed body is sent, so open our own, and only for as
+    # long as each database step takes: the stream waits on google and on the client in between
+    async with AsyncSessionLocal() as db:
+        await ensure_user(db, user_id)
+        cached_route = await lookup_cached_route(db, origin, destination, mode)
+
+    result = route_cache_result(cached_route)
+    ROUTE_CACHE_LOOKUPS.inc(result=result)
+    if result in ('hit', 'stale'):
+        if result == 'stale':
+            revalidate_route(origin, destination, mode, cached_route)
+        access_tracker.route_accessed(cached_route.id)
+        routes = cached_route.payload.routes()
+        await record_view(cached_route, origin, destination, mode, user_id)
+        event = {"type": "routes", "routes": routes, "enriched": True}
+        if cached_route.degraded:
+            event["degraded"] = cached_route.degraded
+        yield format_stream_event(event, stream_format)
+        yield format_stream_event({"type": "end", "_links": links}, stream_format)
+        return
+
+    # computed like any other request for the trip, so concurrent requests share one computation; when
+    # this request is the one computing, its progress is streamed as it happens
+    events = asyncio.Queue()
+    flight = asyncio.ensure_future(route_flights.do(
+        batch_key(origin, destination, mode),
+        lambda: compute_route_payload(origin, destination, mode, EnrichmentContext(), stale=cached_route,
+                                      on_event=lambda event: events.put_nowait(format_stream_event(event, stream_format)))))
+    flight.add_done_callback(lambda _: events.put_nowait(None))
+
+    streamed = False
     try:
-        routes = get_accessible_routes(db, origin, destination, mode, user_id)
-        ASYNC_TASK_RESULTS[task_id] = {"status": "completed", "routes": routes}
-    except Exception as e:
-        ASYNC_TASK_RESULTS[task_id] = {"status": "failed", "error": str(e)}
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            streamed = True
+            yield event
+    finally:
+        # only stops waiting: the computation carries on for everyone else waiting on it
+        flight.cancel()
+    payload, cached_route, degraded = flight.result()
+
+    if payload is None:
+        yield format_stream_event({"type": "error", "error": "Error retrieving routes."}, stream_format)
+        yield format_stream_event({"type": "end"}, stream_format)
+        return
+
+    access_tracker.route_accessed(cached_route.id)
+    await record_view(cached_route, origin, destination, mode, user_id)
+
+    end = {"type": "end", "_links": links}
+    if not streamed:
+        # another request was already computing the trip, or google failed and an expired copy is served
+        event = {"type": "routes", "routes": payload.routes(), "enriched": True}
+        if degraded:
+            event["degraded"] = degraded
+        yield format_stream_event(event, stream_format)
+    elif degraded:
+        # what was streamed is incomplete; a complete expired copy, if there was one, stays cached
+        end["degraded"] = 'partial'
+    yield format_stream_event(end, stream_format)
+
+
+# streaming is chosen by ?stream=ndjson|sse, or by an Accept header asking for either format
+def requested_stream_format(request: Request, stream=None):
+    if stream in ('ndjson', 'sse'):
+        return stream
+    accept = request.headers.get('accept', '')
+    if 'text/event-stream' in accept:
+        return 'sse'
+    if 'application/x-ndjson' in accept:
+        return 'ndjson'
+    return None
+
+
+def streaming_routes_response(origin, destination, mode, user_id, stream_format):
+    media_type = "text/event-stream" if stream_format == 'sse' else "application/x-ndjson"
+    return StreamingResponse(
+        stream_accessible_routes(origin, destination, mode, user_id, stream_format),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
+# runs one /routes/async job; workers open their own session since the submitting request is long gone
+async def process_route_job(job):
+    async with AsyncSessionLocal() as db:
+        return await get_accessible_routes(db, job["origin"], job["destination"], job["mode"], job["user_id"])
+
+
+if JOB_STORE == 'memory':
+    job_store = MemoryJobStore(result_ttl=JOB_RESULT_TTL, max_queued=JOB_QUEUE_LIMIT)
+else:
+    job_store = DatabaseJobStore(AsyncSessionLocal, result_ttl=JOB_RESULT_TTL, max_queued=JOB_QUEUE_LIMIT)
+
+job_pool = WorkerPool(
+    job_store,
+    process_route_job,
+    concurrency=JOB_WORKERS,
+    poll_interval=JOB_POLL_INTERVAL,
+    stale_after=JOB_STALE_AFTER
+)
+
+# background refresh of a popular trip, by its cache key; normalized keys are valid directions queries
+async def refresh_route(origin_key, destination_key, mode):
+    async with AsyncSessionLocal() as db:
+        stale = await get_cached_route(db, origin_key, destination_key, mode)
+    payload, _, degraded = await route_flights.do(
+        (origin_key, destination_key, mode),
+        lambda: compute_route_payload(origin_key, destination_key, mode, EnrichmentContext(), stale=stale))
+    if degraded:
+        return degraded
+    return 'ok' if payload is not None else 'no_routes'
+
+
+async def refresh_place(place_id):
+    try:
+        refreshed = await place_details_cache.refresh(place_id, fetch_place_details)
+    except UPSTREAM_ERRORS as e:
+        logger.warning(f"Error refreshing place details: {e}")
+        return 'unavailable'
+    return 'ok' if refreshed else 'not_found'
+
+
+def warm_route(row):
+    if len(route_memory_cache) >= route_memory_cache.maxsize:
+        return False
+    remember_route((row.origin_key, row.destination_key, row.mode), row.id, row.expires_at, row.route_blob,
+                   row.route_data if row.route_blob is None else None, row.degraded)
+    return True
+
+
+def create_refresh_scheduler():
+    return RefreshScheduler(
+        AsyncSessionLocal,
+        refresh_route,
+        refresh_place=refresh_place if PLACE_CACHE_DB else None,
+        warm_route=warm_route,
+        warm_place=(lambda row: place_details_cache.warm(row.place_id, row.details, row.expires_at))
+        if PLACE_CACHE_DB else None,
+        interval=REFRESH_INTERVAL,
+        refresh_ahead=REFRESH_AHEAD,
+        hot_window=REFRESH_HOT_WINDOW,
+        min_hits=REFRESH_MIN_HITS,
+        batch_size=REFRESH_BATCH_SIZE,
+        concurrency=REFRESH_CONCURRENCY,
+        evict_after=CACHE_EVICT_AFTER,
+        evict_interval=CACHE_EVICT_INTERVAL
+    )
+
+
+# recent job latencies change slowly; don't recompute them for every status poll
+job_latency_cache = TTLCache(maxsize=1, ttl=5)
+
+# queue depth needs a database query, so it is refreshed when /metrics is scraped
+JOB_QUEUE_DEPTH = registry.gauge('job_queue_depth', "Jobs waiting for a worker")
+registry.gauge('jobs_running', "Jobs being processed by this process",
+               collect=lambda: {(): job_pool.running})
 
-ASYNC_TASK_RESULTS = {}
 
 @app.post("/routes/async")
-async def routes_post_async(data: dict, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+async def routes_post_async(data: dict):
     origin = data.get('origin')
     destination = data.get('destination')
     mode = data.get('mode', 'walking')
@@ -215,10 +938,15 @@ async def routes_post_async(data: dict, background_tasks: BackgroundTasks, db: S
     if not origin or not destination or not user_id:
         return JSONResponse(content={"error": "Origin, destination, and user_id are required."}, status_code=400)
 
-    task_id = f"task-{int(time.time())}"
-    ASYNC_TASK_RESULTS[task_id] = {"status": "processing"}
-
-    background_tasks.add_task(process_route_async, task_id, origin, destination, mode, user_id, db)
+    try:
+        task_id = await job_store.submit(origin, destination, mode, user_id)
+    except QueueFull:
+        return JSONResponse(
+            content={"error": "Too many queued requests, try again later."},
+            status_code=503,
+            headers={"Retry-After": "5"}
+        )
+    job_pool.notify()
 
     status_url = f"/routes/async/status/{task_id}"
     headers = {"Location": status_url}
@@ -238,30 +966,185 @@ async def get_task_status(task_id: str):
     """
     Get the status of an asynchronous task.
     """
-    task_result = ASYNC_TASK_RESULTS.get(task_id)
-    if not task_result:
+    job = await job_store.get(task_id)
+    if not job:
         return JSONResponse(content={"error": "Task not found."}, status_code=404)
 
+    recent = job_latency_cache.get('recent')
+    if recent is None:
+        recent = await job_store.recent_latencies()
+        job_latency_cache.set('recent', recent)
+
+    now = utcnow()
+    started_at = job["started_at"]
+    finished_at = job["finished_at"]
+    task_result = {
+        "status": job["status"],
+        "queue_depth": await job_store.queue_depth(),
+        "latency": {
+            "queued_seconds": ((started_at or now) - job["created_at"]).total_seconds(),
+            "run_seconds": ((finished_at or now) - started_at).total_seconds() if started_at else None,
+            "recent": recent,
+        },
+    }
+    if job["status"] == 'completed':
+        task_result["routes"] = job["result"]
+    elif job["status"] == 'failed':
+        task_result["error"] = job["error"]
+
     return JSONResponse(content=task_result, status_code=200)
 
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
 
+@app.get("/cache/stats")
+def cache_stats():
+    """
+    Hit/miss statistics for the in-process route, place details and nearby search caches.
+    """
+    return {
+        "route": {
+            "entries": len(route_memory_cache),
+            "hits": route_memory_cache.hits,
+            "misses": route_memory_cache.misses,
+        },
+        "place_details": {
+            "entries": len(place_details_cache.memory),
+            "hits": place_details_cache.memory.hits,
+            "misses": place_details_cache.memory.misses,
+            "coalesced": place_details_cache.flights.coalesced,
+        },
+        "nearby_search": nearby_index.stats(),
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Service metrics in the Prometheus text format.
+    """
+    if not METRICS_ENABLED:
+        return JSONResponse(content={"error": "Metrics are disabled."}, status_code=404)
+    try:
+        JOB_QUEUE_DEPTH.set(await job_store.queue_depth())
+    except Exception:
+        logger.exception("Error reading job queue depth")
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# route template serving a request (e.g. /routes/{route_id}), so metrics aren't split per id
+def endpoint_for(scope):
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     logger.info(f"Request: {request.method} {request.url}")
 
+    endpoint = endpoint_for(request.scope) if METRICS_ENABLED else None
+    if endpoint is not None:
+        current_endpoint.set(endpoint)
+
     start_time = time.time()
     response = await call_next(request)
     process_time = time.time() - start_time
 
+    if endpoint is not None:
+        HTTP_REQUEST_SECONDS.observe(process_time, method=request.method, endpoint=endpoint,
+                                     status=response.status_code)
     logger.info(f"Response status: {response.status_code} | Time: {process_time:.4f}s")
     return response
 
 
+# opaque keyset cursor: the last route id the client has seen
+def encode_cursor(route_id):
+    return base64.urlsafe_b64encode(json.dumps({"id": route_id}).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(padded))["id"])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+async def count_viewed_routes(db: AsyncSession, user_id):
+    total_items = viewed_count_cache.get(user_id)
+    if total_items is None:
+        total_items = await db.scalar(select(func.count()).select_from(Route).filter(Route.user_id == user_id))
+        viewed_count_cache.set(user_id, total_items)
+    return total_items
+
+
+def viewed_route_summary(route, user_id):
+    return {
+        'id': route.id,
+        'origin': route.origin,
+        'destination': route.destination,
+        'mode': route.mode,
+        '_links': {
+            'self': f'/routes/{route.id}?user_id={user_id}',
+            'delete': f'/routes/{route.id}?user_id={user_id}'
+        }
+    }
+
+
+@app.get("/viewed_routes")
+async def viewed_routes_keyset(user_id: str = None, limit: int = 10, cursor: str = None, include_total: bool = False,
+                               db: AsyncSession = Depends(get_db)):
+    """
+    Fetches the latest viewed routes for a specific user, newest first, using keyset pagination.
+    Follow `pagination._links.next` until it is null.
+    """
+    if not user_id:
+        return JSONResponse(content={"error": "user_id is required."}, status_code=400)
+
+    if limit < 1 or limit > HISTORY_MAX_LIMIT:
+        return JSONResponse(content={"error": f"limit must be between 1 and {HISTORY_MAX_LIMIT}."}, status_code=400)
+
+    query = (
+        select(Route.id, Route.origin, Route.destination, Route.mode)
+        .filter(Route.user_id == user_id)
+        .order_by(Route.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor:
+        try:
+            query = query.filter(Route.id < decode_cursor(cursor))
+        except ValueError as e:
+            return JSONResponse(content={"error": str(e)}, status_code=400)
+
+    result = await db.execute(query)
+    rows = result.all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = encode_cursor(rows[-1].id) if has_more else None
+    pagination_info = {
+        'limit': limit,
+        'nextCursor': next_cursor,
+        '_links': {
+            'self': f'/viewed_routes?user_id={user_id}&limit={limit}' + (f'&cursor={cursor}' if cursor else ''),
+            'first': f'/viewed_routes?user_id={user_id}&limit={limit}',
+            'next': f'/viewed_routes?user_id={user_id}&limit={limit}&cursor={next_cursor}' if next_cursor else None
+        }
+    }
+    if include_total:
+        pagination_info['totalItems'] = await count_viewed_routes(db, user_id)
+
+    return JSONResponse(content={
+        "routes": [viewed_route_summary(route, user_id) for route in rows],
+        "pagination": pagination_info
+    })
+
+
 @app.get("/viewed_routes/page/{page}")
-def viewed_routes(page: int, limit: int = 10, user_id: str = None, db: Session = Depends(get_db)):
+async def viewed_routes(page: int, limit: int = 10, user_id: str = None, db: AsyncSession = Depends(get_db)):
     """
     Fetches the latest viewed routes for a specific user, paginated.
     """
@@ -273,34 +1156,22 @@ def viewed_routes(page: int, limit: int = 10, user_id: str = None, db: Session =
 
     offset = (page - 1) * limit
 
-    routes_query = (
-        db.query(Route)
+    result = await db.execute(
+        select(Route.id, Route.origin, Route.destination, Route.mode)
         .filter(Route.user_id == user_id)
         .order_by(Route.id.desc())
         .offset(offset)
         .limit(limit)
-        .all()
     )
+    routes_query = result.all()
 
-    total_items = db.query(Route).filter(Route.user_id == user_id).count()
+    total_items = await count_viewed_routes(db, user_id)
     total_pages = (total_items + limit - 1) // limit
 
     if not routes_query:
         return JSONResponse({"error": "No routes found for this user."}, status_code=404)
 
-    route_data_res = [
-        {
-            'id': route.id,
-            'origin': route.origin,
-            'destination': route.destination,
-            'mode': route.mode,
-            '_links': {
-                'self': f'/routes/{route.id}?user_id={user_id}',
-                'delete': f'/routes/{route.id}?user_id={user_id}'
-            }
-        }
-        for route in routes_query
-    ]
+    route_data_res = [viewed_route_summary(route, user_id) for route in routes_query]
 
     pagination_info = {
         'totalItems': total_items,
@@ -320,28 +1191,33 @@ def viewed_routes(page: int, limit: int = 10, user_id: str = None, db: Session =
 
 
 @app.get("/routes")
-async def routes_get(origin: str, destination: str, mode: str = "walking", user_id: str = "1", db: Session = Depends(get_db)):
+async def routes_get(request: Request, origin: str, destination: str, mode: str = "walking", user_id: str = "1",
+                     stream: str = None, db: AsyncSession = Depends(get_db)):
     if not origin or not destination or not user_id:
         return JSONResponse(content={"error": "Origin, destination, and user_id are required."}, status_code=400)
 
-    routes = get_accessible_routes(db, origin, destination, mode, user_id)
-    if routes:
-        return JSONResponse(
-            content={
-                "routes": routes,
-                "_links": {
-                    "self": f"/routes?origin={origin}&destination={destination}&mode={mode}&user_id={user_id}",
-                    "viewed_routes": f"/viewed_routes/page/1?user_id={user_id}&limit=10",
-                }
+    stream_format = requested_stream_format(request, stream)
+    if stream_format:
+        return streaming_routes_response(origin, destination, mode, user_id, stream_format)
+
+    ctx = EnrichmentContext()
+    payload = await get_accessible_routes_payload(db, origin, destination, mode, user_id, ctx)
+    if payload:
+        return routes_response(
+            payload,
+            {
+                "self": f"/routes?origin={origin}&destination={destination}&mode={mode}&user_id={user_id}",
+                "viewed_routes": f"/viewed_routes/page/1?user_id={user_id}&limit=10",
             },
-            status_code=200
+            status_code=200,
+            degraded=ctx.degraded
         )
     else:
-        return JSONResponse(content={"error": "Error retrieving routes."}, status_code=500)
+        return routes_error_response(ctx)
 
 
 @app.post("/routes")
-async def routes_post(data: dict, db: Session = Depends(get_db)):
+async def routes_post(request: Request, data: dict, db: AsyncSession = Depends(get_db)):
     origin = data.get('origin')
     destination = data.get('destination')
     mode = data.get('mode', 'walking')
@@ -350,47 +1226,227 @@ async def routes_post(data: dict, db: Session = Depends(get_db)):
     if not origin or not destination or not user_id:
         return JSONResponse(content={"error": "Origin, destination, and user_id are required."}, status_code=400)
 
-    routes = get_accessible_routes(db, origin, destination, mode, user_id)
-    if routes:
+    stream_format = requested_stream_format(request, data.get('stream') or request.query_params.get('stream'))
+    if stream_format:
+        return streaming_routes_response(origin, destination, mode, user_id, stream_format)
+
+    ctx = EnrichmentContext()
+    payload = await get_accessible_routes_payload(db, origin, destination, mode, user_id, ctx)
+    if payload:
         resource_url = f"/routes?origin={origin}&destination={destination}&mode={mode}&user_id={user_id}"
         headers = {"Location": resource_url, "Link": f'<{resource_url}>; rel="self"'}
-        return JSONResponse(
-            content={
-                "routes": routes,
-                "_links": {
-                    "self": resource_url,
-                    "viewed_routes": f"/viewed_routes/page/1?user_id={user_id}&limit=10",
-                }
+        return routes_response(
+            payload,
+            {
+                "self": resource_url,
+                "viewed_routes": f"/viewed_routes/page/1?user_id={user_id}&limit=10",
             },
             status_code=201,
-            headers=headers
+            headers=headers,
+            degraded=ctx.degraded
         )
     else:
-        return JSONResponse(content={"error": "Error retrieving routes."}, status_code=500)
+        return routes_error_response(ctx)
+
+def batch_key(origin, destination, mode):
+    return normalize_location(origin), normalize_location(destination), mode.lower()
+
+
+# why a batch item can't be computed, or None when it can
+def batch_item_error(item):
+    if not item.get('origin') or not item.get('destination'):
+        return "Origin and destination are required."
+    if not all(isinstance(item.get(field, 'walking'), str) for field in ('origin', 'destination', 'mode')):
+        return "Origin, destination and mode must be strings."
+    return None
+
+
+async def stream_batch_routes(items, user_id):
+    ctx = EnrichmentContext()
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    # identical triples are computed once and answered for every index that asked for them
+    groups = {}
+    for index, item in enumerate(items):
+        if batch_item_error(item):
+            continue
+        key = batch_key(item['origin'], item['destination'], item.get('mode', 'walking'))
+        groups.setdefault(key, []).append(index)
+
+    async def run(key, first_index, forward):
+        item = items[first_index]
+        # a reversed trip has its own directions, but probes the same places; let the forward trip
+        # warm the caches first so the reverse is served mostly from them
+        if forward is not None:
+            await asyncio.wait([forward])
+        trip_ctx = ctx.for_trip()
+        try:
+            async with semaphore:
+                async with AsyncSessionLocal() as db:
+                    routes = await get_accessible_routes(
+                        db, item['origin'], item['destination'], item.get('mode', 'walking'), user_id, trip_ctx)
+            return key, routes, None, trip_ctx.degraded
+        except Exception as e:
+            logger.exception("Batch route failed")
+            return key, None, str(e), None
+
+    tasks = {}
+    for key, indices in groups.items():
+        origin_key, destination_key, mode = key
+        forward = tasks.get((destination_key, origin_key, mode))
+        tasks[key] = asyncio.ensure_future(run(key, indices[0], forward))
+
+    def line(index, **fields):
+        item = items[index]
+        return json.dumps({
+            "index": index,
+            "origin": item.get('origin'),
+            "destination": item.get('destination'),
+            "mode": item.get('mode', 'walking'),
+            **fields
+        }) + "\n"
+
+    try:
+        for index, item in enumerate(items):
+            error = batch_item_error(item)
+            if error:
+                yield line(index, error=error)
+
+        for done in asyncio.as_completed(tasks.values()):
+            key, routes, error, degraded = await done
+            for index in groups[key]:
+                if routes:
+                    yield line(index, routes=routes, **({"degraded": degraded} if degraded else {}))
+                elif error:
+                    yield line(index, error=f"Error retrieving routes: {error}")
+                else:
+                    yield line(index, error="Error retrieving routes.")
+    finally:
+        # the client went away; stop computing results nobody will read
+        for task in tasks.values():
+            task.cancel()
+
+
+@app.post("/routes/batch")
+async def routes_post_batch(data: dict):
+    """
+    Computes many origin/destination/mode triples at once, streaming one NDJSON line per triple as
+    soon as its routes are ready. Lines arrive in completion order; `index` refers to the request list.
+    """
+    items = data.get('requests')
+    user_id = data.get('user_id')
+
+    if not user_id or not isinstance(items, list) or not items:
+        return JSONResponse(content={"error": "user_id and a non-empty requests list are required."}, status_code=400)
+
+    if len(items) > BATCH_MAX_SIZE:
+        return JSONResponse(content={"error": f"A batch may contain at most {BATCH_MAX_SIZE} requests."}, status_code=400)
+
+    if not all(isinstance(item, dict) for item in items):
+        return JSONResponse(content={"error": "Each request must be an object."}, status_code=400)
+
+    return StreamingResponse(stream_batch_routes(items, user_id), media_type="application/x-ndjson")
+
+USER_ROUTE_FIELDS = ('id', 'origin', 'destination', 'mode', 'route_data')
+
+
+def user_routes_query(user_id, fields):
+    columns = [Route.id, Route.origin, Route.destination, Route.mode]
+    query = select(*columns).filter(Route.user_id == user_id).order_by(Route.id)
+    # the payload lives in the shared cache table; only join it when the client wants it
+    if 'route_data' in fields:
+        query = query.add_columns(CachedRoute.route_blob, CachedRoute.route_data).join(
+            CachedRoute, Route.route_cache_id == CachedRoute.id)
+    return query
+
+
+def user_route_payload(row):
+    return RoutePayload(blob=row.route_blob, text=row.route_data if row.route_blob is None else None)
+
+
+def user_route_item(row, fields):
+    item = {field: getattr(row, field) for field in fields if field != 'route_data'}
+    if 'route_data' in fields:
+        item['route_data'] = user_route_payload(row).routes()
+    return item
+
+
+# one route as JSON bytes, with the stored route_data bytes spliced in rather than parsed and re-serialized
+def user_route_json(row, fields):
+    item = dumps_compact({field: getattr(row, field) for field in fields if field != 'route_data'})
+    if 'route_data' not in fields:
+        return item
+    separator = b'' if item == b'{}' else b','
+    return item[:-1] + separator + b'"route_data":' + user_route_payload(row).json_bytes() + b'}'
+
+
+# writes the same {"routes": [...]} document as the paginated response, a batch of rows at a time
+async def stream_user_routes(user_id, fields):
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(user_routes_query(user_id, fields).execution_options(yield_per=100))
+        yield b'{"routes":['
+        first = True
+        async for row in result:
+            yield (b'' if first else b',') + user_route_json(row, fields)
+            first = False
+        yield b']}'
+
 
 @app.get("/user/{user_id}/routes")
-async def get_user_routes(user_id: str, db: Session = Depends(get_db)):
-    routes = db.query(Route).filter_by(user_id=user_id).all()
-    
-    if not routes:
+async def get_user_routes(user_id: str, fields: str = None, limit: int = None, cursor: str = None,
+                          db: AsyncSession = Depends(get_db)):
+    """
+    Fetches a user's saved routes, oldest first. `fields` selects a comma-separated subset of
+    id, origin, destination, mode and route_data. With `limit` or `cursor` the result is paginated
+    by keyset; otherwise every route is streamed in one response.
+    """
+    fields = [field.strip() for field in fields.split(',')] if fields else list(USER_ROUTE_FIELDS)
+    unknown = [field for field in fields if field not in USER_ROUTE_FIELDS]
+    if unknown:
+        return JSONResponse(content={"error": f"Unknown fields: {', '.join(unknown)}."}, status_code=400)
+
+    if limit is None and cursor is None:
+        has_routes = await db.scalar(select(Route.id).filter(Route.user_id == user_id).limit(1))
+        if has_routes is None:
+            return JSONResponse(content={"error": "No routes found for this user."}, status_code=500)
+        return StreamingResponse(stream_user_routes(user_id, fields), media_type="application/json")
+
+    limit = HISTORY_MAX_LIMIT if limit is None else limit
+    if limit < 1 or limit > HISTORY_MAX_LIMIT:
+        return JSONResponse(content={"error": f"limit must be between 1 and {HISTORY_MAX_LIMIT}."}, status_code=400)
+
+    query = user_routes_query(user_id, fields).limit(limit + 1)
+    if cursor:
+        try:
+            query = query.filter(Route.id > decode_cursor(cursor))
+        except ValueError as e:
+            return JSONResponse(content={"error": str(e)}, status_code=400)
+
+    result = await db.execute(query)
+    rows = result.all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if not rows and not cursor:
         return JSONResponse(content={"error": "No routes found for this user."}, status_code=500)
 
-    user_routes = [
-        {
-            "id": route.id,
-            "origin": route.origin,
-            "destination": route.destination,
-            "mode": route.mode,
-            "route_data": json.loads(route.route_data)
+    next_cursor = encode_cursor(rows[-1].id) if has_more else None
+    field_param = f"&fields={','.join(fields)}"
+    return JSONResponse(content={
+        "routes": [user_route_item(row, fields) for row in rows],
+        "pagination": {
+            "limit": limit,
+            "nextCursor": next_cursor,
+            "_links": {
+                "next": f"/user/{user_id}/routes?limit={limit}&cursor={next_cursor}{field_param}" if next_cursor else None
+            }
         }
-        for route in routes
-    ]
-
-    return JSONResponse(content={"routes": user_routes}, status_code=200)
+    }, status_code=200)
 
 @app.delete("/routes/{route_id}")
-async def delete_route(route_id: int, user_id: str, db: Session = Depends(get_db)):
-    route = db.query(Route).filter_by(id=route_id, user_id=user_id).first()
+async def delete_route(route_id: int, user_id: str, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(select(Route).filter_by(id=route_id, user_id=user_id))
+    route = result.scalars().first()
 
     if not route:
         return JSONResponse(
@@ -399,8 +1455,9 @@ async def delete_route(route_id: int, user_id: str, db: Session = Depends(get_db
         )
 
     try:
-        db.delete(route)
-        db.commit()
+        await db.delete(route)
+        await db.commit()
+        viewed_count_cache.pop(user_id)
         return JSONResponse(
             content={
                 "message": f"Route with ID {route_id} for User ID {user_id} has been deleted.",
@@ -412,7 +1469,7 @@ async def delete_route(route_id: int, user_id: str, db: Session = Depends(get_db
             status_code=200
         )
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         return JSONResponse(
             content={"error": f"An error occurred while deleting the route: {str(e)}"},
             status_code=500
@@ -0,0 +1,125 @@
+"""
+Micro-benchmark for accessibility review classification.
+
+Compares the original per-keyword substring scan with AccessibilityClassifier, per review and in
+batch, over a synthetic review corpus with keywords injected into a fraction of the reviews. Also
+times the enrichment path, where every probe that finds a place scores it: reviews are classified
+once when the details are fetched and each probe only scans the name, against classifying the name
+and reviews again on every probe. Run from the repository root:
+
+    python benchmarks/bench_classifier.py --reviews 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collections import Counter
+
+from accessibility import AccessibilityClassifier, DEFAULT_KEYWORDS, DEFAULT_PLACE_TYPES
+
+FILLER = (
+    'the station was clean and staff were friendly but the platform gets crowded at rush hour and trains '
+    'ran late twice this week parking is hard to find on weekends coffee shop nearby is great prices are '
+    'fair and the lighting at night could be better overall a decent place to pass through'
+).split()
+
+
+def make_corpus(count, keyword_rate, seed):
+    rng = random.Random(seed)
+    reviews = []
+    for _ in range(count):
+        words = rng.choices(FILLER, k=rng.randint(20, 120))
+        if rng.random() < keyword_rate:
+            words.insert(rng.randrange(len(words)), rng.choice(DEFAULT_KEYWORDS))
+        reviews.append({"text": ' '.join(words).capitalize() + '.'})
+    return reviews
+
+
+def make_places(batches, seed):
+    rng = random.Random(seed)
+    return [
+        (' '.join(rng.choices(FILLER, k=2) + ([rng.choice(DEFAULT_KEYWORDS)] if rng.random() < 0.2 else [])).title(),
+         [rng.choice(DEFAULT_PLACE_TYPES)], reviews)
+        for reviews in batches
+    ]
+
+
+# as find_accessible_places and fetch_place_details do: reviews classified once per place, when its
+# details are fetched, then every probe scans only the name and scores from the stored counts
+def enrichment_path(classifier, places, probes_per_place):
+    fetched = [classifier.review_matches(reviews) for _, _, reviews in places]
+    for _ in range(probes_per_place):
+        for (name, types, _), (relevant, review_terms) in zip(places, fetched):
+            name_terms = classifier.matches(name)
+            if name_terms or relevant:
+                classifier.score_place(name_terms, types, review_terms)
+
+
+# name and reviews classified again by every probe, with the name scanned twice
+def reclassify_per_probe(classifier, places, probes_per_place):
+    for _ in range(probes_per_place):
+        for name, types, reviews in places:
+            classifier.is_relevant(name)
+            relevant = classifier.relevant_reviews(reviews)
+            if relevant or classifier.is_relevant(name):
+                review_terms = Counter()
+                for counts in classifier.classify_reviews(relevant):
+                    review_terms.update(counts)
+                classifier.score_place(classifier.matches(name), types, review_terms)
+
+
+def naive(reviews, keywords):
+    return [review for review in reviews if any(keyword in review.get('text', '').lower() for keyword in keywords)]
+
+
+def timed(label, fn, repeat):
+    best = min(_run(fn) for _ in range(repeat))
+    print(f"{label:<32} {best * 1000:10.1f} ms")
+    return best
+
+
+def _run(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark accessibility review classification")
+    parser.add_argument('--reviews', type=int, default=100000)
+    parser.add_argument('--keyword-rate', type=float, default=0.1)
+    parser.add_argument('--batch-size', type=int, default=5, help="reviews per place, as returned by place details")
+    parser.add_argument('--probes-per-place', type=int, default=3,
+                        help="probes that find the same place, as overlapping probes along a route do")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    reviews = make_corpus(args.reviews, args.keyword_rate, args.seed)
+    classifier = AccessibilityClassifier()
+    batches = [reviews[i:i + args.batch_size] for i in range(0, len(reviews), args.batch_size)]
+
+    print(f"{len(reviews)} reviews, {len(classifier.keywords)} keywords, {len(batches)} places")
+    baseline = timed("substring scan per keyword", lambda: naive(reviews, DEFAULT_KEYWORDS), args.repeat)
+    per_review = timed("classifier per review", lambda: [r for r in reviews if classifier.is_relevant(r['text'])],
+                       args.repeat)
+    per_place = timed("classifier batch per place", lambda: [classifier.relevant_reviews(b) for b in batches],
+                      args.repeat)
+    whole = timed("classifier whole corpus", lambda: classifier.classify_reviews(reviews), args.repeat)
+    print(f"speedup vs substring scan: per review {baseline / per_review:.1f}x, "
+          f"per place {baseline / per_place:.1f}x, whole corpus {baseline / whole:.1f}x")
+
+    places = make_places(batches, args.seed)
+    reclassify = timed("enrichment, reclassify per probe",
+                       lambda: reclassify_per_probe(classifier, places, args.probes_per_place), args.repeat)
+    once = timed("enrichment, classify on fetch",
+                 lambda: enrichment_path(classifier, places, args.probes_per_place), args.repeat)
+    print(f"enrichment speedup from classifying once: {reclassify / once:.1f}x")
+
+    # the classifier matches whole words only, so it may flag fewer reviews than the substring scan
+    flagged = sum(len(classifier.relevant_reviews(b)) for b in batches)
+    print(f"relevant reviews: substring scan {len(naive(reviews, DEFAULT_KEYWORDS))}, classifier {flagged}")
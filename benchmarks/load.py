@@ -0,0 +1,268 @@
+"""
+End-to-end load benchmark for the service, runnable offline.
+
+Starts fake_google.py in a subprocess as the upstream, so building its responses doesn't compete with
+the service for the interpreter, points the service at it and at a throwaway SQLite database (unless
+--database-url is given), then drives each scenario at the requested
+concurrency and reports throughput, latency percentiles and upstream calls per API. Responses that
+say they are degraded (stale, or missing some places) are counted apart from errors; async job results
+don't say, so they can't be told apart. The service's Google rate limits are pinned by --rate-limit
+(unlimited by default), so cold runs measure the service rather than its token buckets. Everything is
+seeded, so runs with the same arguments are comparable across commits:
+
+    python benchmarks/load.py --requests 200 --concurrency 20 --latency-ms 50
+
+Use --target to drive an already running service instead of the in-process app; its
+GOOGLE_MAPS_BASE_URL must then point at the fake server given by --upstream.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+
+SCENARIOS = ('routes_cold', 'routes_warm', 'routes_async', 'viewed_routes')
+USERS = 50
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_google(args):
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, 'fake_google.py'),
+        '--port', str(port),
+        '--mode', args.upstream_mode,
+        '--fixtures', args.fixtures,
+        '--latency-ms', str(args.latency_ms),
+        '--jitter-ms', str(args.jitter_ms),
+        '--error-rate', str(args.error_rate),
+        '--routes', str(args.routes),
+        '--steps', str(args.steps),
+        '--places', str(args.places),
+        '--seed', str(args.seed),
+    ], stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+
+    deadline = time.monotonic() + 30
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f"fake_google.py exited with status {process.returncode}")
+        try:
+            httpx.get(f"{url}/__stats").raise_for_status()
+            return url, process
+        except httpx.HTTPError:
+            if time.monotonic() > deadline:
+                process.terminate()
+                raise RuntimeError("fake_google.py did not start within 30s")
+            time.sleep(0.1)
+
+
+async def run_requests(count, concurrency, make_request):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    degraded = 0
+
+    async def one(i):
+        nonlocal errors, degraded
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                outcome = await make_request(i)
+            except Exception:
+                outcome = False
+            latencies.append(time.perf_counter() - start)
+            if not outcome:
+                errors += 1
+            elif outcome == 'degraded':
+                degraded += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return latencies, errors, degraded, time.perf_counter() - start
+
+
+# True for a complete answer, 'degraded' when the body says it isn't one, False for an error
+def routes_outcome(response, expected_status):
+    if response.status_code != expected_status:
+        return False
+    return 'degraded' if 'degraded' in response.json() else True
+
+
+def trip(i, prefix='bench'):
+    return {"origin": f"{prefix} origin {i}", "destination": f"{prefix} destination {i % 7}", "mode": "walking"}
+
+
+def scenario_requests(name, client, run_id):
+    if name == 'routes_cold':
+        async def request(i):
+            body = {**trip(i, f"cold {run_id}"), "user_id": f"bench-{i % USERS}"}
+            response = await client.post("/routes", json=body)
+            return routes_outcome(response, 201)
+        return None, request
+
+    if name == 'routes_warm':
+        body = {**trip(0, f"warm {run_id}"), "user_id": "bench-0"}
+
+        async def prime():
+            await client.post("/routes", json=body)
+
+        async def request(i):
+            response = await client.get("/routes", params={**body, "user_id": f"bench-{i % USERS}"})
+            return routes_outcome(response, 200)
+        return prime, request
+
+    if name == 'routes_async':
+        async def request(i):
+            body = {**trip(i, f"async {run_id}"), "user_id": f"bench-{i % USERS}"}
+            response = await client.post("/routes/async", json=body)
+            if response.status_code != 202:
+                return False
+            status_url = response.headers['location']
+            while True:
+                status = (await client.get(status_url)).json()
+                if status.get('status') in ('completed', 'failed'):
+                    return status['status'] == 'completed'
+                await asyncio.sleep(0.05)
+        return None, request
+
+    if name == 'viewed_routes':
+        async def request(i):
+            user_id = f"bench-{i % USERS}"
+            response = await client.get("/viewed_routes", params={"user_id": user_id, "limit": 5})
+            if response.status_code != 200:
+                return False
+            next_url = response.json()['pagination']['_links']['next']
+            if next_url:
+                response = await client.get(next_url)
+            page = await client.get("/viewed_routes/page/1", params={"user_id": user_id, "limit": 5})
+            return response.status_code == 200 and page.status_code in (200, 404)
+        return None, request
+
+    raise ValueError(f"Unknown scenario: {name}")
+
+
+async def run(args):
+    upstream_url, fake_process = (args.upstream, None) if args.upstream else start_fake_google(args)
+    upstream = httpx.AsyncClient(base_url=upstream_url)
+
+    if args.target:
+        client = httpx.AsyncClient(base_url=args.target, timeout=300)
+        lifespan = None
+    else:
+        # the app reads its configuration at import time, so set it up before importing
+        os.environ['GOOGLE_MAPS_BASE_URL'] = upstream_url
+        os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'bench')
+        for api in ('DIRECTIONS', 'NEARBY', 'DETAILS'):
+            os.environ[f'{api}_RATE_LIMIT'] = str(args.rate_limit)
+        os.environ['DATABASE_URL'] = args.database_url or \
+            f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+        import logging
+        logging.disable(logging.INFO)
+
+        import database
+        import models  # noqa: F401  registers the tables
+        import app
+        await database.create_tables()
+
+        lifespan = app.app.router.lifespan_context(app.app)
+        await lifespan.__aenter__()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://bench", timeout=300)
+
+    run_id = str(int(time.time()))
+    results = []
+    try:
+        for name in args.scenarios:
+            prime, request = scenario_requests(name, client, run_id)
+            if prime:
+                await prime()
+            await upstream.post("/__reset")
+            latencies, errors, degraded, elapsed = await run_requests(args.requests, args.concurrency, request)
+            upstream_stats = (await upstream.get("/__stats")).json()
+            results.append({
+                "scenario": name,
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "errors": errors,
+                "degraded": degraded,
+                "throughput_rps": args.requests / elapsed,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "upstream_calls": {
+                    api: upstream_stats.get(f"{api}_calls", 0) for api in ('directions', 'nearbysearch', 'details')
+                },
+            })
+    finally:
+        await client.aclose()
+        await upstream.aclose()
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+        if fake_process is not None:
+            fake_process.terminate()
+            fake_process.wait()
+
+    return results
+
+
+def print_results(results):
+    print(f"{'scenario':<15}{'reqs':>6}{'conc':>6}{'errors':>8}{'degraded':>10}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}   upstream calls (directions/nearby/details)")
+    for r in results:
+        calls = r['upstream_calls']
+        print(f"{r['scenario']:<15}{r['requests']:>6}{r['concurrency']:>6}{r['errors']:>8}{r['degraded']:>10}"
+              f"{r['throughput_rps']:>9.1f}"
+              f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}   "
+              f"{calls['directions']}/{calls['nearbysearch']}/{calls['details']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark against a fake Google upstream")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        type=lambda value: [name.strip() for name in value.split(',') if name.strip()])
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--target', help="base URL of an already running service")
+    parser.add_argument('--upstream', help="base URL of an already running fake_google.py")
+    parser.add_argument('--database-url', help="database for the in-process app; defaults to a temporary SQLite file")
+    parser.add_argument('--upstream-mode', choices=['synthetic', 'replay'], default='synthetic')
+    parser.add_argument('--fixtures', default=os.path.join(ROOT, 'fixtures'))
+    parser.add_argument('--latency-ms', type=float, default=30.0)
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--routes', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--places', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help="Google calls per second per API allowed to the in-process app; 0 means unlimited. "
+                             "With --target, the running service's own limits apply")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
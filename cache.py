@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+from datetime import timedelta
+
+from sqlalchemy import select, update, insert, bindparam
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from models import PlaceDetails, utcnow
+from resilience import SingleFlight, Batcher
+from ttl_cache import TTLCache, MISSING
+
+logger = logging.getLogger(__name__)
+
+
+class PlaceDetailsCache:
+    """
+    Two-tier cache for place details: an in-process LRU in front of an optional database table.
+
+    Lookups that `fetch` answers with None are cached in memory for `negative_ttl` seconds so a broken
+    place_id is not retried on every step that mentions it. Exceptions from `fetch` are not cached.
+    Concurrent misses for the same place_id share one lookup. The database tier only ever helps: when
+    it fails, the lookup carries on as if it weren't there.
+
+    Database reads and writes are batched: place_ids looked up or stored at about the same time share
+    one query, and at most `db_concurrency` sessions are open at once, however many places a request
+    looks up.
+    """
+    def __init__(self, maxsize=10000, ttl=604800, negative_ttl=300, session_factory=None, db_concurrency=4):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.session_factory = session_factory
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.flights = SingleFlight()
+        db_semaphore = asyncio.Semaphore(db_concurrency)
+        self.loads = Batcher(self._load_batch, db_semaphore)
+        self.stores = Batcher(self._store_batch, db_semaphore)
+
+    # returns the cached details, or None when the lookup failed (now or recently)
+    async def get_or_fetch(self, place_id, fetch):
+        details = self.memory.get(place_id, MISSING)
+        if details is not MISSING:
+            return details
+        return await self.flights.do(place_id, lambda: self._load_or_fetch(place_id, fetch))
+
+    async def _load_or_fetch(self, place_id, fetch):
+        if self.session_factory is not None:
+            details = await self.loads.submit(place_id)
+            if details is not None:
+                self.memory.set(place_id, details)
+                return details
+
+        details = await fetch(place_id)
+        if details is None:
+            self.memory.set(place_id, None, ttl=self.negative_ttl)
+            return None
+
+        self.memory.set(place_id, details)
+        if self.session_factory is not None:
+            await self.stores.submit(place_id, details)
+        return details
+
+    # fetches ahead of expiry and replaces both tiers; a failed lookup leaves the cached details in place
+    async def refresh(self, place_id, fetch):
+        details = await fetch(place_id)
+        if details is None:
+            return False
+        self.memory.set(place_id, details)
+        if self.session_factory is not None:
+            await self.stores.submit(place_id, details)
+        return True
+
+    # puts details read from the database into memory, e.g. at startup; False once memory is full
+    def warm(self, place_id, details, expires_at):
+        if len(self.memory) >= self.memory.maxsize:
+            return False
+        ttl = (expires_at - utcnow()).total_seconds()
+        if ttl > 0:
+            self.memory.set(place_id, json.loads(details), ttl=min(ttl, self.ttl))
+        return True
+
+    async def _load_batch(self, place_ids):
+        try:
+            async with self.session_factory() as db:
+                rows = await db.execute(
+                    select(PlaceDetails.place_id, PlaceDetails.details)
+                    .filter(PlaceDetails.place_id.in_(place_ids), PlaceDetails.expires_at > utcnow())
+                )
+                return {place_id: json.loads(details) for place_id, details in rows}
+        except SQLAlchemyError:
+            logger.exception("Error reading cached place details")
+            return {}
+
+    async def _store_batch(self, details_by_id):
+        now = utcnow()
+        expires_at = now + timedelta(seconds=self.ttl)
+        table = PlaceDetails.__table__
+        try:
+            async with self.session_factory() as db:
+                # a second try covers places another process inserted between our read and insert
+                for attempt in range(2):
+                    result = await db.execute(select(table.c.place_id).filter(table.c.place_id.in_(details_by_id)))
+                    existing = set(result.scalars())
+                    try:
+                        if existing:
+                            await db.execute(
+                                update(table)
+                                .where(table.c.place_id == bindparam('key'))
+                                .values(details=bindparam('value'), fetched_at=now, expires_at=expires_at),
+                                [{"key": place_id, "value": json.dumps(details_by_id[place_id])}
+                                 for place_id in existing]
+                            )
+                        if len(existing) < len(details_by_id):
+                            await db.execute(insert(table), [
+                                {"place_id": place_id, "details": json.dumps(details), "fetched_at": now,
+                                 "expires_at": expires_at}
+                                for place_id, details in details_by_id.items() if place_id not in existing
+                            ])
+                        await db.commit()
+                        return
+                    except IntegrityError:
+                        await db.rollback()
+                logger.warning(f"Gave up storing {len(details_by_id)} place details after concurrent inserts")
+        except SQLAlchemyError:
+            logger.exception("Error storing place details")
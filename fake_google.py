@@ -0,0 +1,308 @@
+"""
+Local stand-in for the Google Maps web services used by the service (Directions, Places Nearby
+Search and Place Details), for benchmarks and offline development.
+
+Modes:
+    synthetic  generate deterministic responses from the request parameters (default)
+    replay     serve responses previously saved with `record`; unknown requests get ZERO_RESULTS
+    record     forward requests to the real Google APIs and save each response as a fixture
+
+Point the service at it with GOOGLE_MAPS_BASE_URL, e.g.:
+
+    python fake_google.py --port 8001 --latency-ms 80 --error-rate 0.01
+    GOOGLE_MAPS_BASE_URL=http://127.0.0.1:8001 python app.py
+"""
+from collections import Counter
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import argparse
+import asyncio
+import hashlib
+import httpx
+import json
+import math
+import os
+import random
+import uvicorn
+
+from accessibility import DEFAULT_KEYWORDS, DEFAULT_PLACE_TYPES
+
+REAL_BASE_URL = "https://maps.googleapis.com"
+
+FILLER_WORDS = (
+    'clean busy quiet friendly staff crowded platform entrance exit parking coffee great slow fast '
+    'expensive cheap bright dark stairs escalator tickets machine line wait open closed'
+).split()
+
+PLACE_TYPES = list(DEFAULT_PLACE_TYPES) + ['cafe', 'restaurant', 'store', 'park', 'bank', 'pharmacy']
+
+
+class FakeGoogleConfig:
+    def __init__(self, mode='synthetic', fixtures_dir='fixtures', latency_ms=0.0, jitter_ms=0.0, error_rate=0.0,
+                 routes=3, steps=20, step_length_m=120, places=10, reviews=5, keyword_rate=0.2, seed=0,
+                 api_key=None):
+        self.mode = mode
+        self.fixtures_dir = fixtures_dir
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.routes = routes
+        self.steps = steps
+        self.step_length_m = step_length_m
+        self.places = places
+        self.reviews = reviews
+        self.keyword_rate = keyword_rate
+        self.seed = seed
+        self.api_key = api_key
+
+
+def encode_polyline(points):
+    """
+    Encodes (lat, lng) pairs with Google's encoded polyline algorithm.
+    """
+    result = []
+    prev_lat = prev_lng = 0
+    for lat, lng in points:
+        lat_e5, lng_e5 = round(lat * 1e5), round(lng * 1e5)
+        for delta in (lat_e5 - prev_lat, lng_e5 - prev_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                result.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            result.append(chr(value + 63))
+        prev_lat, prev_lng = lat_e5, lng_e5
+    return ''.join(result)
+
+
+def _rng(config, *parts):
+    digest = hashlib.sha1(repr((config.seed,) + parts).encode()).digest()
+    return random.Random(int.from_bytes(digest[:8], 'big'))
+
+
+def _offset(lat, lng, north_m, east_m):
+    return lat + north_m / 111320.0, lng + east_m / (111320.0 * math.cos(math.radians(lat)))
+
+
+def _location_for(config, name):
+    rng = _rng(config, 'location', name.lower().strip())
+    return 40.70 + rng.random() * 0.12, -74.02 + rng.random() * 0.09
+
+
+def synthetic_directions(config, params):
+    origin, destination = params.get('origin', ''), params.get('destination', '')
+    start = _location_for(config, origin)
+    end = _location_for(config, destination)
+    rng = _rng(config, 'directions', origin, destination, params.get('mode'))
+
+    routes = []
+    for route_index in range(config.routes):
+        # alternatives bow out to either side of the straight line between the endpoints
+        bow = (route_index - (config.routes - 1) / 2) * 0.004
+        points = []
+        for i in range(config.steps + 1):
+            t = i / config.steps
+            lat = start[0] + (end[0] - start[0]) * t + math.sin(math.pi * t) * bow
+            lng = start[1] + (end[1] - start[1]) * t - math.sin(math.pi * t) * bow
+            points.append((lat + rng.uniform(-1e-4, 1e-4), lng + rng.uniform(-1e-4, 1e-4)))
+
+        steps = []
+        for (lat1, lng1), (lat2, lng2) in zip(points, points[1:]):
+            # a few intermediate vertices per step, as real step polylines have
+            vertices = [(lat1 + (lat2 - lat1) * k / 4, lng1 + (lng2 - lng1) * k / 4) for k in range(5)]
+            steps.append({
+                "distance": {"text": f"{config.step_length_m} m", "value": config.step_length_m},
+                "duration": {"text": "2 mins", "value": 90},
+                "start_location": {"lat": lat1, "lng": lng1},
+                "end_location": {"lat": lat2, "lng": lng2},
+                "html_instructions": f"Continue toward <b>{destination}</b>",
+                "polyline": {"points": encode_polyline(vertices)},
+                "travel_mode": params.get('mode', 'walking').upper(),
+            })
+
+        routes.append({
+            "bounds": {},
+            "copyrights": "Fake data",
+            "legs": [{
+                "start_address": origin,
+                "end_address": destination,
+                "start_location": {"lat": points[0][0], "lng": points[0][1]},
+                "end_location": {"lat": points[-1][0], "lng": points[-1][1]},
+                "steps": steps,
+            }],
+            "overview_polyline": {"points": encode_polyline(points)},
+            "summary": f"Fake route {route_index + 1}",
+            "warnings": [],
+            "waypoint_order": [],
+        })
+    return {"status": "OK", "routes": routes}
+
+
+def _text(rng, config, words):
+    text = [rng.choice(FILLER_WORDS) for _ in range(words)]
+    if rng.random() < config.keyword_rate:
+        text.insert(rng.randrange(len(text) + 1), rng.choice(DEFAULT_KEYWORDS))
+    return ' '.join(text).capitalize()
+
+
+def synthetic_nearby(config, params):
+    lat, lng = (float(value) for value in params.get('location', '0,0').split(','))
+    radius = float(params.get('radius', 200))
+    # places are tied to a ~100 m grid so nearby queries see overlapping results, as in a real city
+    cell = (round(lat, 3), round(lng, 3))
+    rng = _rng(config, 'nearby', cell)
+
+    results = []
+    for i in range(config.places):
+        place_lat, place_lng = _offset(lat, lng, rng.uniform(-radius, radius) * 0.7, rng.uniform(-radius, radius) * 0.7)
+        name = _text(rng, config, 2).title()
+        results.append({
+            "place_id": f"fake-{cell[0]}-{cell[1]}-{i}",
+            "name": name,
+            "geometry": {"location": {"lat": place_lat, "lng": place_lng}},
+            "types": [rng.choice(PLACE_TYPES), 'point_of_interest'],
+        })
+    return {"status": "OK", "results": results}
+
+
+def synthetic_details(config, params):
+    place_id = params.get('place_id', '')
+    rng = _rng(config, 'details', place_id)
+    reviews = [
+        {"author_name": f"Reviewer {i}", "rating": rng.randint(1, 5), "text": _text(rng, config, rng.randint(15, 60))}
+        for i in range(config.reviews)
+    ]
+    return {
+        "status": "OK",
+        "result": {
+            "rating": round(rng.uniform(2.5, 5.0), 1),
+            "user_ratings_total": rng.randint(1, 5000),
+            "reviews": reviews,
+        },
+    }
+
+
+SYNTHETIC = {
+    'directions': synthetic_directions,
+    'nearbysearch': synthetic_nearby,
+    'details': synthetic_details,
+}
+
+PATHS = {
+    'directions': "/maps/api/directions/json",
+    'nearbysearch': "/maps/api/place/nearbysearch/json",
+    'details': "/maps/api/place/details/json",
+}
+
+EMPTY_RESPONSES = {
+    'directions': {"status": "ZERO_RESULTS", "routes": []},
+    'nearbysearch': {"status": "ZERO_RESULTS", "results": []},
+    'details': {"status": "NOT_FOUND"},
+}
+
+
+def fixture_path(config, api, params):
+    key = json.dumps({k: v for k, v in sorted(params.items()) if k != 'key'}, sort_keys=True)
+    return os.path.join(config.fixtures_dir, api, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+
+def create_app(config: FakeGoogleConfig):
+    fake = FastAPI(title="Fake Google Maps")
+    stats = Counter()
+    real_client = httpx.AsyncClient(base_url=REAL_BASE_URL, timeout=30) if config.mode == 'record' else None
+    error_rng = random.Random(config.seed)
+
+    async def respond(api, request: Request):
+        params = dict(request.query_params)
+        stats[f"{api}_calls"] += 1
+
+        delay = config.latency_ms + (error_rng.uniform(-config.jitter_ms, config.jitter_ms) if config.jitter_ms else 0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        if config.error_rate and error_rng.random() < config.error_rate:
+            stats[f"{api}_errors"] += 1
+            # alternate between the two failure shapes Google produces
+            if error_rng.random() < 0.5:
+                return JSONResponse({"error": "backend error"}, status_code=500)
+            return JSONResponse({"status": "OVER_QUERY_LIMIT", "error_message": "fake quota"})
+
+        if config.mode == 'synthetic':
+            return JSONResponse(SYNTHETIC[api](config, params))
+
+        path = fixture_path(config, api, params)
+        if config.mode == 'replay':
+            if not os.path.exists(path):
+                stats[f"{api}_fixture_misses"] += 1
+                return JSONResponse(EMPTY_RESPONSES[api])
+            with open(path) as f:
+                return JSONResponse(json.load(f))
+
+        response = await real_client.get(PATHS[api], params={**params, "key": config.api_key})
+        body = response.json()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(body, f)
+        return JSONResponse(body, status_code=response.status_code)
+
+    @fake.get(PATHS['directions'])
+    async def directions(request: Request):
+        return await respond('directions', request)
+
+    @fake.get(PATHS['nearbysearch'])
+    async def nearbysearch(request: Request):
+        return await respond('nearbysearch', request)
+
+    @fake.get(PATHS['details'])
+    async def details(request: Request):
+        return await respond('details', request)
+
+    @fake.get("/__stats")
+    def get_stats():
+        return dict(stats)
+
+    @fake.post("/__reset")
+    def reset_stats():
+        stats.clear()
+        return {}
+
+    return fake
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fake Google Maps web services")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--mode', choices=['synthetic', 'replay', 'record'], default='synthetic')
+    parser.add_argument('--fixtures', default='fixtures', help="directory for recorded responses")
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--routes', type=int, default=3, help="alternatives per directions response")
+    parser.add_argument('--steps', type=int, default=20, help="steps per route")
+    parser.add_argument('--places', type=int, default=10, help="results per nearby search")
+    parser.add_argument('--reviews', type=int, default=5, help="reviews per place")
+    parser.add_argument('--keyword-rate', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def config_from_args(args):
+    return FakeGoogleConfig(
+        mode=args.mode,
+        fixtures_dir=args.fixtures,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        routes=args.routes,
+        steps=args.steps,
+        places=args.places,
+        reviews=args.reviews,
+        keyword_rate=args.keyword_rate,
+        seed=args.seed,
+        api_key=os.getenv('GOOGLE_MAPS_API_KEY'),
+    )
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port)
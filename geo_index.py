@@ -0,0 +1,90 @@
+import math
+
+from geo import haversine_m, METRES_PER_DEGREE_LAT
+from resilience import SingleFlight
+from ttl_cache import TTLCache, MISSING
+
+
+class NearbySearchIndex:
+    """
+    Grid-cell index of nearby search results, shared across requests and users.
+
+    The world is cut into roughly `cell_size` metre square cells. A miss searches upstream once from
+    the cell centre, with the radius widened by half the cell diagonal so the stored circle covers the
+    query circle of any point in that cell. Later queries are answered locally whenever a stored circle
+    in their cell or a neighbouring one covers them, and results are filtered by true distance to the
+    query point.
+    """
+    def __init__(self, cell_size=50, max_cells=100000, ttl=86400):
+        self.cell_size = cell_size
+        self.cells = TTLCache(maxsize=max_cells, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self._dlat = cell_size / METRES_PER_DEGREE_LAT
+        self.flights = SingleFlight()
+
+    def _dlng(self, row):
+        centre_lat = (row + 0.5) * self._dlat
+        return self.cell_size / (METRES_PER_DEGREE_LAT * max(math.cos(math.radians(centre_lat)), 1e-6))
+
+    def cell_for(self, lat, lng):
+        row = math.floor(lat / self._dlat)
+        return row, math.floor(lng / self._dlng(row))
+
+    def cell_centre(self, cell):
+        row, col = cell
+        dlng = self._dlng(row)
+        return (row + 0.5) * self._dlat, (col + 0.5) * dlng
+
+    def _covering_entry(self, lat, lng, radius):
+        row = math.floor(lat / self._dlat)
+        for r in (row, row - 1, row + 1):
+            col = math.floor(lng / self._dlng(r))
+            for c in (col, col - 1, col + 1):
+                entry = self.cells.get((r, c), MISSING)
+                if entry is MISSING:
+                    continue
+                centre_lat, centre_lng, covered_radius, places = entry
+                if haversine_m(centre_lat, centre_lng, lat, lng) + radius <= covered_radius:
+                    return entry
+        return None
+
+    @staticmethod
+    def _within(places, lat, lng, radius):
+        nearby = []
+        for place in places:
+            location = place.get('geometry', {}).get('location')
+            if location and haversine_m(lat, lng, location['lat'], location['lng']) <= radius:
+                nearby.append(place)
+        return nearby
+
+    # fetch(lat, lng, radius) performs the upstream search and returns its results, or None on failure
+    async def search(self, lat, lng, radius, fetch):
+        entry = self._covering_entry(lat, lng, radius)
+        if entry is not None:
+            self.hits += 1
+            return self._within(entry[3], lat, lng, radius)
+
+        self.misses += 1
+        cell = self.cell_for(lat, lng)
+        centre_lat, centre_lng = self.cell_centre(cell)
+        covered_radius = radius + self.cell_size * math.sqrt(2) / 2
+
+        # steps that land in the same cell at the same time, in any request, share one upstream search
+        places = await self.flights.do(
+            (cell, covered_radius), lambda: fetch(centre_lat, centre_lng, round(covered_radius)))
+
+        if places is None:
+            return None
+        self.cells.set(cell, (centre_lat, centre_lng, covered_radius, places))
+        return self._within(places, lat, lng, radius)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "cells": len(self.cells),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "coalesced": self.flights.coalesced,
+        }
@@ -0,0 +1,346 @@
+from collections import OrderedDict, deque
+from datetime import timedelta
+from sqlalchemy import select, update, delete, func
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+
+from models import Job, utcnow
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+PROCESSING = 'processing'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    pass
+
+
+def new_job_id():
+    return f"task-{uuid.uuid4().hex}"
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(durations):
+    return {
+        "count": len(durations),
+        "p50": percentile(durations, 50),
+        "p95": percentile(durations, 95),
+    }
+
+
+def _job_to_dict(job):
+    return {
+        "id": job.id,
+        "status": job.status,
+        "origin": job.origin,
+        "destination": job.destination,
+        "mode": job.mode,
+        "user_id": job.user_id,
+        "result": json.loads(job.result) if job.result is not None else None,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+
+class JobStore:
+    """
+    Interface for job persistence. Every method is safe to call from several worker processes,
+    as long as the implementation itself is shared between them.
+    """
+    async def submit(self, origin, destination, mode, user_id):
+        raise NotImplementedError
+
+    # atomically move the oldest queued job to processing; None when the queue is empty
+    async def claim(self, worker_id):
+        raise NotImplementedError
+
+    async def complete(self, job_id, result):
+        raise NotImplementedError
+
+    async def fail(self, job_id, error):
+        raise NotImplementedError
+
+    async def get(self, job_id):
+        raise NotImplementedError
+
+    async def queue_depth(self):
+        raise NotImplementedError
+
+    # queue wait and run time of recently finished jobs
+    async def recent_latencies(self, sample=100):
+        raise NotImplementedError
+
+    # drop expired results and requeue jobs whose worker stopped responding
+    async def sweep(self, stale_after):
+        raise NotImplementedError
+
+
+class DatabaseJobStore(JobStore):
+    """
+    Jobs kept in the `job` table, so any worker behind the load balancer can answer a status poll.
+    """
+    def __init__(self, session_factory, result_ttl=3600, max_queued=1000):
+        self.session_factory = session_factory
+        self.result_ttl = result_ttl
+        self.max_queued = max_queued
+
+    async def submit(self, origin, destination, mode, user_id):
+        if self.max_queued and await self.queue_depth() >= self.max_queued:
+            raise QueueFull()
+
+        job_id = new_job_id()
+        async with self.session_factory() as db:
+            db.add(Job(
+                id=job_id,
+                status=QUEUED,
+                origin=origin,
+                destination=destination,
+                mode=mode,
+                user_id=user_id,
+                created_at=utcnow()
+            ))
+            await db.commit()
+        return job_id
+
+    async def claim(self, worker_id):
+        async with self.session_factory() as db:
+            candidates = await db.scalars(
+                select(Job.id).filter(Job.status == QUEUED).order_by(Job.created_at).limit(5)
+            )
+            for job_id in candidates.all():
+                # the status check makes the claim atomic: only one worker's update matches the row
+                result = await db.execute(
+                    update(Job)
+                    .filter(Job.id == job_id, Job.status == QUEUED)
+                    .values(status=PROCESSING, worker_id=worker_id, started_at=utcnow())
+                )
+                await db.commit()
+                if result.rowcount == 1:
+                    job = await db.get(Job, job_id)
+                    return _job_to_dict(job)
+        return None
+
+    async def _finish(self, job_id, status, result=None, error=None):
+        now = utcnow()
+        async with self.session_factory() as db:
+            await db.execute(
+                update(Job)
+                .filter(Job.id == job_id)
+                .values(
+                    status=status,
+                    result=json.dumps(result) if result is not None else None,
+                    error=error,
+                    finished_at=now,
+                    expires_at=now + timedelta(seconds=self.result_ttl)
+                )
+            )
+            await db.commit()
+
+    async def complete(self, job_id, result):
+        await self._finish(job_id, COMPLETED, result=result)
+
+    async def fail(self, job_id, error):
+        await self._finish(job_id, FAILED, error=error)
+
+    async def get(self, job_id):
+        async with self.session_factory() as db:
+            job = await db.get(Job, job_id)
+            if job is None or (job.expires_at is not None and job.expires_at <= utcnow()):
+                return None
+            return _job_to_dict(job)
+
+    async def queue_depth(self):
+        async with self.session_factory() as db:
+            return await db.scalar(select(func.count()).select_from(Job).filter(Job.status == QUEUED))
+
+    async def recent_latencies(self, sample=100):
+        async with self.session_factory() as db:
+            rows = await db.execute(
+                select(Job.created_at, Job.started_at, Job.finished_at)
+                .filter(Job.finished_at.is_not(None))
+                .order_by(Job.finished_at.desc())
+                .limit(sample)
+            )
+            rows = rows.all()
+        return {
+            "queue_wait_seconds": summarize([(s - c).total_seconds() for c, s, f in rows if s]),
+            "run_seconds": summarize([(f - s).total_seconds() for c, s, f in rows if s]),
+        }
+
+    async def sweep(self, stale_after):
+        now = utcnow()
+        async with self.session_factory() as db:
+            expired = await db.execute(delete(Job).filter(Job.expires_at <= now))
+            requeued = await db.execute(
+                update(Job)
+                .filter(Job.status == PROCESSING, Job.started_at <= now - timedelta(seconds=stale_after))
+                .values(status=QUEUED, worker_id=None, started_at=None)
+            )
+            await db.commit()
+        return expired.rowcount, requeued.rowcount
+
+
+class MemoryJobStore(JobStore):
+    """
+    Jobs kept in this process only; for single-process deployments and local development.
+    """
+    def __init__(self, result_ttl=3600, max_queued=1000):
+        self.result_ttl = result_ttl
+        self.max_queued = max_queued
+        self._jobs = OrderedDict()
+        self._queue = deque()
+
+    async def submit(self, origin, destination, mode, user_id):
+        if self.max_queued and len(self._queue) >= self.max_queued:
+            raise QueueFull()
+
+        job_id = new_job_id()
+        self._jobs[job_id] = {
+            "id": job_id,
+            "status": QUEUED,
+            "origin": origin,
+            "destination": destination,
+            "mode": mode,
+            "user_id": user_id,
+            "result": None,
+            "error": None,
+            "created_at": utcnow(),
+            "started_at": None,
+            "finished_at": None,
+            "expires_at": None,
+        }
+        self._queue.append(job_id)
+        return job_id
+
+    async def claim(self, worker_id):
+        while self._queue:
+            job = self._jobs.get(self._queue.popleft())
+            if job is not None and job["status"] == QUEUED:
+                job.update(status=PROCESSING, started_at=utcnow())
+                return dict(job)
+        return None
+
+    def _finish(self, job_id, status, result=None, error=None):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            now = utcnow()
+            job.update(status=status, result=result, error=error, finished_at=now,
+                       expires_at=now + timedelta(seconds=self.result_ttl))
+
+    async def complete(self, job_id, result):
+        self._finish(job_id, COMPLETED, result=result)
+
+    async def fail(self, job_id, error):
+        self._finish(job_id, FAILED, error=error)
+
+    async def get(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None or (job["expires_at"] is not None and job["expires_at"] <= utcnow()):
+            return None
+        return dict(job)
+
+    async def queue_depth(self):
+        return len(self._queue)
+
+    async def recent_latencies(self, sample=100):
+        finished = [job for job in reversed(self._jobs.values()) if job["finished_at"]][:sample]
+        return {
+            "queue_wait_seconds": summarize([(j["started_at"] - j["created_at"]).total_seconds() for j in finished]),
+            "run_seconds": summarize([(j["finished_at"] - j["started_at"]).total_seconds() for j in finished]),
+        }
+
+    async def sweep(self, stale_after):
+        now = utcnow()
+        expired = [job_id for job_id, job in self._jobs.items() if job["expires_at"] and job["expires_at"] <= now]
+        for job_id in expired:
+            del self._jobs[job_id]
+        return len(expired), 0
+
+
+class WorkerPool:
+    """
+    Fixed number of asyncio workers pulling jobs from a JobStore, so at most `concurrency` jobs run at
+    once in this process. Workers poll the store, and are woken immediately for jobs submitted here.
+    """
+    def __init__(self, store, handler, concurrency=4, poll_interval=1.0, sweep_interval=60, stale_after=600):
+        self.store = store
+        self.handler = handler
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.sweep_interval = sweep_interval
+        self.stale_after = stale_after
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.running = 0
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._sweep()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self):
+        while True:
+            try:
+                job = await self.store.claim(self.worker_id)
+            except Exception:
+                logger.exception("Error claiming job")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.running += 1
+            start_time = time.perf_counter()
+            try:
+                result = await self.handler(job)
+                await self.store.complete(job["id"], result)
+            except Exception as e:
+                logger.exception(f"Job {job['id']} failed")
+                try:
+                    await self.store.fail(job["id"], str(e))
+                except Exception:
+                    logger.exception(f"Error recording failure of job {job['id']}")
+            finally:
+                self.running -= 1
+                logger.info(f"Job {job['id']} finished in {time.perf_counter() - start_time:.4f}s")
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                expired, requeued = await self.store.sweep(self.stale_after)
+                if expired or requeued:
+                    logger.info(f"Job sweep: {expired} expired, {requeued} requeued")
+            except Exception:
+                logger.exception("Error sweeping jobs")
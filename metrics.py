@@ -0,0 +1,261 @@
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+import contextvars
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# metrics are on by default; tracing needs the opentelemetry API and an SDK configured by the deployment
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+_tracer = trace.get_tracer("google-maps-microservice") if trace is not None and TRACING_ENABLED else None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# the endpoint (route template) the current request is being served by, for metrics recorded deep in
+# the call stack such as database timings; work outside a request, like job workers, is "background"
+current_endpoint = contextvars.ContextVar('current_endpoint', default='background')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    """
+    Base class for metrics with a fixed set of label names; one series per distinct label values.
+
+    `collect`, when given, is called at scrape time and returns {label values tuple: value}, for
+    counters and gauges read from state the service already keeps.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _current(self):
+        if self.collect is not None:
+            return self.collect()
+        with self._lock:
+            return dict(self._series)
+
+    def samples(self):
+        raise NotImplementedError
+
+    # the family name in HELP/TYPE lines, which must match the sample names
+    def family(self):
+        return self.name
+
+    def render(self):
+        family = self.family()
+        lines = [f"# HELP {family} {self.documentation}", f"# TYPE {family} {self.type}"]
+        for suffix, labelvalues, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, labelvalues, extra)} "
+                         f"{_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    # counter samples are suffixed _total; in the 0.0.4 text format their HELP/TYPE lines are too
+    def family(self):
+        return self.name + '_total'
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def samples(self):
+        return [('_total', key, (), value) for key, value in sorted(self._current().items())]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def samples(self):
+        return [('', key, (), value) for key, value in sorted(self._current().items())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # per-bucket (non-cumulative) counts, then sum and count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    # times the block and records its duration, whether or not it raised
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            series = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items())
+        samples = []
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', key, (('le', _format_value(float(bound))),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), collect=None):
+        return self.register(Counter(name, documentation, labelnames, collect))
+
+    def gauge(self, name, documentation, labelnames=(), collect=None):
+        return self.register(Gauge(name, documentation, labelnames, collect))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    # Prometheus text exposition format, version 0.0.4
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+registry = Registry()
+
+HTTP_REQUEST_SECONDS = registry.histogram(
+    'http_request_duration_seconds', "Time to produce the response headers, per endpoint",
+    ('method', 'endpoint', 'status'))
+
+UPSTREAM_REQUESTS = registry.counter(
+    'upstream_requests', "Google Maps API calls by API and outcome", ('api', 'outcome'))
+UPSTREAM_SECONDS = registry.histogram(
+    'upstream_request_duration_seconds', "Google Maps API call latency, excluding time queued behind the "
+    "per-request concurrency limit", ('api', 'outcome'))
+UPSTREAM_RETRIES = registry.counter(
+    'upstream_retries', "Google Maps API calls retried after a 5xx, timeout or OVER_QUERY_LIMIT", ('api',))
+UPSTREAM_REJECTED = registry.counter(
+    'upstream_rejected', "Google Maps API calls not made, by reason (circuit_open, rate_limit, daily_quota)",
+    ('api', 'reason'))
+
+ENRICHMENT_PROBE_SECONDS = registry.histogram(
+    'enrichment_probe_duration_seconds', "Time to find accessible places around one probe point")
+ENRICHMENT_REQUEST_SECONDS = registry.histogram(
+    'enrichment_request_duration_seconds', "Time to enrich every step of one directions response")
+ENRICHMENT_PROBES = registry.histogram(
+    'enrichment_probes', "Probe points searched per directions response", buckets=(1, 5, 10, 25, 50, 100, 250, 500))
+
+ROUTE_STAGE_SECONDS = registry.histogram(
+    'route_stage_duration_seconds', "Time spent in each stage of computing accessible routes", ('stage',))
+ROUTE_CACHE_LOOKUPS = registry.counter(
+    'route_cache_lookups', "Shared route cache lookups by result (hit, stale, expired, miss)", ('result',))
+
+DB_QUERY_SECONDS = registry.histogram(
+    'db_query_duration_seconds', "Database statement execution time, per endpoint",
+    ('endpoint', 'statement'))
+
+
+# a block of work that is timed into `histogram` and, when tracing is enabled, wrapped in a span
+def stage(name, histogram=ROUTE_STAGE_SECONDS, **attributes):
+    if not METRICS_ENABLED and _tracer is None:
+        return nullcontext()
+    return _stage(name, histogram, attributes)
+
+
+@contextmanager
+def _stage(name, histogram, attributes):
+    span = _tracer.start_as_current_span(name, attributes=attributes) if _tracer is not None else nullcontext()
+    with span:
+        if histogram is not None and METRICS_ENABLED:
+            with histogram.time(stage=name):
+                yield
+        else:
+            yield
+
+
+# record the duration of every statement run through `engine`, labelled with the current endpoint
+def instrument_engine(engine):
+    if not METRICS_ENABLED:
+        return
+
+    from sqlalchemy import event
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        DB_QUERY_SECONDS.observe(elapsed, endpoint=current_endpoint.get(),
+                                 statement=statement.lstrip().split(None, 1)[0].lower())
+
+    @event.listens_for(engine.sync_engine, 'handle_error')
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('query_start'):
+            connection.info['query_start'].pop()
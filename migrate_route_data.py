@@ -0,0 +1,59 @@
+"""
+Converts legacy plain-JSON route_cache.route_data rows to the compressed route_blob encoding.
+
+Before running it against an existing MySQL database, add the new column and relax the old one:
+
+    ALTER TABLE route_cache ADD COLUMN route_blob LONGBLOB NULL, MODIFY route_data LONGTEXT NULL;
+
+Rows are converted in id order, one batch per transaction, so it is safe to rerun and to run while
+the service is serving traffic: unconverted rows stay readable through route_data until their turn.
+"""
+from sqlalchemy import select, update
+import argparse
+import asyncio
+import os
+
+from database import AsyncSessionLocal
+from models import CachedRoute
+from route_codec import RoutePayload
+
+
+async def migrate(batch_size, codec, level):
+    converted = 0
+    last_id = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(CachedRoute.id, CachedRoute.route_data)
+                .filter(CachedRoute.id > last_id, CachedRoute.route_blob.is_(None), CachedRoute.route_data.is_not(None))
+                .order_by(CachedRoute.id)
+                .limit(batch_size)
+            )
+            rows = result.all()
+            if not rows:
+                return converted
+
+            for row in rows:
+                # re-dump compactly so the stored bytes match what new rows would contain
+                payload = RoutePayload.from_routes(RoutePayload(text=row.route_data).routes())
+                await db.execute(
+                    update(CachedRoute)
+                    .filter(CachedRoute.id == row.id, CachedRoute.route_blob.is_(None))
+                    .values(route_blob=payload.blob(codec, level), route_data=None)
+                )
+            await db.commit()
+
+        converted += len(rows)
+        last_id = rows[-1].id
+        print(f"Converted {converted} routes (last id {last_id})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--codec', choices=['zlib', 'zstd'], default=os.getenv('ROUTE_CODEC', 'zlib'))
+    parser.add_argument('--level', type=int, default=int(os.getenv('ROUTE_CODEC_LEVEL', '6')))
+    args = parser.parse_args()
+
+    total = asyncio.run(migrate(args.batch_size, args.codec, args.level))
+    print(f"Done, {total} routes converted")
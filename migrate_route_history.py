@@ -0,0 +1,90 @@
+"""
+Moves routes stored per user in route.route_data into the shared route_cache table.
+
+Before running it against an existing MySQL database, stop the service, create the new tables and
+add the new column next to the old one:
+
+    python -c "import asyncio, database, models; asyncio.run(database.create_tables())"
+    ALTER TABLE route ADD COLUMN route_cache_id INT NULL, ADD INDEX ix_route_user_id_id (user_id, id),
+        ADD CONSTRAINT fk_route_route_cache FOREIGN KEY (route_cache_id) REFERENCES route_cache (id);
+
+Then run this script, and once it reports no routes left, drop the old column:
+
+    ALTER TABLE route MODIFY route_cache_id INT NOT NULL, DROP COLUMN route_data;
+
+Each trip gets one shared entry, built from the first stored copy of it in id order, and every
+user's row for the trip points at it. The old copies were never enriched, so the entries expire at
+the epoch, long enough ago that they are never served as stale: the next request for a trip
+recomputes it, while each user's history can still read the old copy.
+Rows are migrated in id order, one batch per transaction, so the script is safe to rerun.
+"""
+from sqlalchemy import select, text
+from datetime import datetime
+import argparse
+import asyncio
+import os
+
+from database import AsyncSessionLocal
+from models import CachedRoute, normalize_location, utcnow
+from route_codec import RoutePayload
+
+# expiry of the migrated entries; anything older than ROUTE_STALE_WHILE_REVALIDATE would do
+LEGACY_EXPIRES_AT = datetime(1970, 1, 1)
+
+
+async def shared_entry(db, origin, destination, mode, route_data, codec, level):
+    key = dict(origin_key=normalize_location(origin), destination_key=normalize_location(destination),
+               mode=mode.lower())
+    result = await db.execute(select(CachedRoute.id).filter_by(**key))
+    cached_route_id = result.scalar()
+    if cached_route_id is not None:
+        return cached_route_id
+
+    now = utcnow()
+    cached_route = CachedRoute(
+        **key,
+        route_blob=RoutePayload.from_routes(RoutePayload(text=route_data).routes()).blob(codec, level),
+        created_at=now,
+        expires_at=LEGACY_EXPIRES_AT
+    )
+    db.add(cached_route)
+    await db.flush()
+    return cached_route.id
+
+
+async def migrate(batch_size, codec, level):
+    migrated = 0
+    last_id = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                text("SELECT id, origin, destination, mode, route_data FROM route "
+                     "WHERE id > :last_id AND route_cache_id IS NULL ORDER BY id LIMIT :batch_size"),
+                {"last_id": last_id, "batch_size": batch_size}
+            )
+            rows = result.all()
+            if not rows:
+                remaining = await db.execute(text("SELECT COUNT(*) FROM route WHERE route_cache_id IS NULL"))
+                return migrated, remaining.scalar()
+
+            for row in rows:
+                cached_route_id = await shared_entry(
+                    db, row.origin, row.destination, row.mode, row.route_data, codec, level)
+                await db.execute(text("UPDATE route SET route_cache_id = :cached_route_id WHERE id = :id"),
+                                 {"cached_route_id": cached_route_id, "id": row.id})
+            await db.commit()
+
+        migrated += len(rows)
+        last_id = rows[-1].id
+        print(f"Migrated {migrated} routes (last id {last_id})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--codec', choices=['zlib', 'zstd'], default=os.getenv('ROUTE_CODEC', 'zlib'))
+    parser.add_argument('--level', type=int, default=int(os.getenv('ROUTE_CODEC_LEVEL', '6')))
+    args = parser.parse_args()
+
+    total, remaining = asyncio.run(migrate(args.batch_size, args.codec, args.level))
+    print(f"Done, {total} routes migrated, {remaining} left without a shared entry")
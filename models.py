@@ -0,0 +1,112 @@
+from sqlalchemy.orm import relationship, deferred
+from sqlalchemy import Column, Integer, String, Text, DateTime, LargeBinary, UniqueConstraint, ForeignKey, Index
+from sqlalchemy.dialects.mysql import LONGTEXT, LONGBLOB
+from datetime import datetime, timezone
+from database import Base
+from route_codec import RoutePayload
+
+
+# LONGTEXT on MySQL, plain TEXT elsewhere (e.g. SQLite for local runs and benchmarks)
+LongText = Text().with_variant(LONGTEXT, 'mysql')
+
+
+def utcnow():
+    # naive UTC, matching how MySQL DATETIME columns are stored
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+# cache keys ignore case and repeated whitespace so "116th and Broadway" and "116th  and broadway" share an entry
+def normalize_location(value: str) -> str:
+    return " ".join(value.lower().split())
+
+
+class User(Base):
+    __tablename__ = 'user'
+    id = Column(String(50), primary_key=True)
+    routes = relationship('Route', back_populates='user')
+
+
+class CachedRoute(Base):
+    """
+    Fully enriched directions result, shared by every user who requests the same trip.
+    """
+    __tablename__ = 'route_cache'
+    id = Column(Integer, primary_key=True)
+    origin_key = Column(String(256), nullable=False)
+    destination_key = Column(String(256), nullable=False)
+    mode = Column(String(50), nullable=False)
+    # payloads are only loaded when asked for, so listing and freshness checks never read them.
+    # route_blob holds the compressed encoding from route_codec; route_data is the legacy plain JSON,
+    # kept readable until migrate_route_data.py has converted every row
+    route_blob = deferred(Column(LargeBinary().with_variant(LONGBLOB, 'mysql')))
+    route_data = deferred(Column(LongText))
+    created_at = Column(DateTime, nullable=False, default=utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    # 'partial' when some place lookups failed while enriching it; such entries are only kept briefly
+    degraded = Column(String(20))
+    # how often the entry has been served and when last; maintained in batches by refresh.AccessTracker
+    hit_count = Column(Integer, nullable=False, default=0, server_default='0')
+    last_accessed_at = Column(DateTime, index=True)
+
+    views = relationship('Route', back_populates='cached_route')
+
+    @property
+    def payload(self):
+        return RoutePayload(blob=self.route_blob, text=self.route_data if self.route_blob is None else None)
+
+    __table_args__ = (UniqueConstraint('origin_key', 'destination_key', 'mode', name='_route_cache_key_uc'),)
+
+
+class Route(Base):
+    """
+    A route the user has viewed; the route payload itself lives in the shared cache entry.
+    """
+    __tablename__ = 'route'
+    id = Column(Integer, primary_key=True)
+    origin = Column(String(256), nullable=False)
+    destination = Column(String(256), nullable=False)
+    mode = Column(String(50), nullable=False)
+    user_id = Column(String(50), ForeignKey('user.id'), nullable=False)
+    route_cache_id = Column(Integer, ForeignKey('route_cache.id'), nullable=False)
+
+    user = relationship('User', back_populates='routes')
+    cached_route = relationship('CachedRoute', back_populates='views')
+
+    __table_args__ = (
+        UniqueConstraint('origin', 'destination', 'mode', 'user_id', name='_origin_destination_user_uc'),
+        # serves the per-user, id-ordered history listings and their keyset pagination
+        Index('ix_route_user_id_id', 'user_id', 'id'),
+    )
+
+
+class PlaceDetails(Base):
+    """
+    Persistent tier of the place details cache, shared by every worker process.
+    """
+    __tablename__ = 'place_details'
+    place_id = Column(String(256), primary_key=True)
+    details = Column(LongText, nullable=False)
+    fetched_at = Column(DateTime, nullable=False, default=utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    hit_count = Column(Integer, nullable=False, default=0, server_default='0')
+    last_accessed_at = Column(DateTime, index=True)
+
+
+class Job(Base):
+    """
+    A queued /routes/async request and, once finished, its result until it expires.
+    """
+    __tablename__ = 'job'
+    id = Column(String(64), primary_key=True)
+    status = Column(String(20), nullable=False, index=True)
+    origin = Column(String(256), nullable=False)
+    destination = Column(String(256), nullable=False)
+    mode = Column(String(50), nullable=False)
+    user_id = Column(String(50), nullable=False)
+    result = Column(LongText)
+    error = Column(Text)
+    worker_id = Column(String(64))
+    created_at = Column(DateTime, nullable=False, default=utcnow, index=True)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    expires_at = Column(DateTime, index=True)
@@ -0,0 +1,225 @@
+import math
+
+from geo import haversine_m, METRES_PER_DEGREE_LAT
+
+# metres between probe points along a route, by travel mode; the faster the mode, the sparser the probes
+DEFAULT_SPACING = {
+    'walking': 150,
+    'bicycling': 300,
+    'transit': 400,
+    'driving': 800,
+}
+
+
+def parse_spacing(value):
+    """
+    Parses per-mode spacings like "walking:150,driving:800" into {mode: metres}. Raises ValueError for
+    a spacing that isn't a positive number, which would never advance along a path.
+    """
+    spacing = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        mode, _, metres = item.partition(':')
+        metres = float(metres)
+        if not metres > 0:
+            raise ValueError(f"Enrichment spacing for {mode.strip()!r} must be positive, got {metres}")
+        spacing[mode.strip().lower()] = metres
+    return spacing
+
+
+def decode_polyline(encoded):
+    """
+    Decodes Google's encoded polyline format into (lat, lng) pairs.
+    """
+    points = []
+    index = lat = lng = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / 1e5, lng / 1e5))
+    return points
+
+
+# the step's own polyline, or just its endpoints when it has none (or a malformed one)
+def step_points(step):
+    encoded = (step.get('polyline') or {}).get('points')
+    if encoded:
+        try:
+            points = decode_polyline(encoded)
+        except IndexError:
+            points = []
+        if points:
+            return points
+    return [(location['lat'], location['lng'])
+            for location in (step.get('start_location'), step.get('end_location')) if location]
+
+
+# points every `spacing` metres along a path, starting half a spacing in, plus the path's end
+def sample_path(points, spacing):
+    samples = []
+    next_at = spacing / 2
+    travelled = 0.0
+    for (lat1, lng1), (lat2, lng2) in zip(points, points[1:]):
+        length = haversine_m(lat1, lng1, lat2, lng2)
+        while length > 0 and travelled + length >= next_at:
+            t = (next_at - travelled) / length
+            samples.append((lat1 + (lat2 - lat1) * t, lng1 + (lng2 - lng1) * t))
+            next_at += spacing
+        travelled += length
+    if points:
+        samples.append(points[-1])
+    return samples
+
+
+# drop points within `distance` metres of one already kept, so overlapping routes share their probes
+def merge_points(points, distance):
+    if distance <= 0:
+        return list(points)
+
+    dlat = distance / METRES_PER_DEGREE_LAT
+    kept = []
+    grid = {}
+    for lat, lng in points:
+        row = math.floor(lat / dlat)
+        dlng = distance / (METRES_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+        col = math.floor(lng / dlng)
+        near = any(
+            haversine_m(lat, lng, other_lat, other_lng) <= distance
+            for r in (row - 1, row, row + 1)
+            for c in (col - 1, col, col + 1)
+            for other_lat, other_lng in grid.get((r, c), ())
+        )
+        if not near:
+            kept.append((lat, lng))
+            grid.setdefault((row, col), []).append((lat, lng))
+    return kept
+
+
+# metres from (lat, lng) to the closest point of a polyline, on a local flat projection
+def distance_to_path_m(lat, lng, points):
+    kx = METRES_PER_DEGREE_LAT * math.cos(math.radians(lat))
+    ky = METRES_PER_DEGREE_LAT
+    best = math.inf
+    previous = None
+    for point_lat, point_lng in points:
+        x, y = (point_lng - lng) * kx, (point_lat - lat) * ky
+        if previous is None:
+            distance = math.hypot(x, y)
+        else:
+            x0, y0 = previous
+            dx, dy = x - x0, y - y0
+            length2 = dx * dx + dy * dy
+            t = 0.0 if length2 == 0 else max(0.0, min(1.0, -(x0 * dx + y0 * dy) / length2))
+            distance = math.hypot(x0 + t * dx, y0 + t * dy)
+        best = min(best, distance)
+        previous = (x, y)
+    return best
+
+
+class EnrichmentPlan:
+    """
+    Where to search for accessible places along a set of alternative routes, and how to put what is
+    found back onto their steps.
+
+    Each route's step polylines are sampled every `spacing` metres, so the number of probes follows
+    route length rather than step count. Probes within `merge_distance` of one already planned are
+    dropped, which lets alternatives share probes where they overlap. When more than `max_probes`
+    remain, the spacing is widened until they fit.
+
+    A place found by any probe is attached to the closest step of every route that passes within
+    `radius` of it.
+    """
+    def __init__(self, routes, spacing, radius, merge_distance=None, max_probes=0):
+        self.radius = radius
+        self.merge_distance = radius / 2 if merge_distance is None else merge_distance
+        self.max_probes = max_probes
+
+        # per route: (position, step, points, bounding box) for each step
+        self.routes = []
+        paths = []
+        for route_index, route in enumerate(routes):
+            steps = []
+            path = []
+            for leg_index, leg in enumerate(route.get('legs', [])):
+                for step_index, step in enumerate(leg.get('steps', [])):
+                    points = step_points(step)
+                    if not points:
+                        continue
+                    lats = [lat for lat, _ in points]
+                    lngs = [lng for _, lng in points]
+                    bbox = (min(lats), min(lngs), max(lats), max(lngs))
+                    steps.append(((route_index, leg_index, step_index), step, points, bbox))
+                    path.extend(points)
+            self.routes.append(steps)
+            paths.append(path)
+
+        self.spacing = spacing
+        self.probes = self._plan(paths)
+        self._attached = {}
+
+    def _plan(self, paths):
+        for _ in range(10):
+            probes = merge_points(
+                [point for path in paths for point in sample_path(path, self.spacing)], self.merge_distance)
+            if not self.max_probes or len(probes) <= self.max_probes:
+                return probes
+            self.spacing *= len(probes) / self.max_probes
+        # still over budget (e.g. more alternatives than probes allowed); keep an even subset
+        step = math.ceil(len(probes) / self.max_probes)
+        return probes[::step]
+
+    def _closest_step(self, steps, lat, lng):
+        dlat = self.radius / METRES_PER_DEGREE_LAT
+        dlng = self.radius / (METRES_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+        best, best_distance = None, self.radius
+        for entry in steps:
+            min_lat, min_lng, max_lat, max_lng = entry[3]
+            if not (min_lat - dlat <= lat <= max_lat + dlat and min_lng - dlng <= lng <= max_lng + dlng):
+                continue
+            distance = distance_to_path_m(lat, lng, entry[2])
+            if distance <= best_distance:
+                best, best_distance = entry, distance
+        return best
+
+    def locate(self, places):
+        """
+        Where places found by a probe belong, without attaching them: (position, step, place) for the
+        closest step of every route that passes near each place.
+        """
+        located = []
+        for place in places:
+            location = place.get('location')
+            if not location:
+                continue
+            for steps in self.routes:
+                entry = self._closest_step(steps, location['lat'], location['lng'])
+                if entry is not None:
+                    located.append((entry[0], entry[1], place))
+        return located
+
+    def assign(self, places):
+        """
+        Attaches places found by a probe to steps, once per step. Returns the positions of the steps
+        that gained places.
+        """
+        changed = set()
+        for position, step, place in self.locate(places):
+            attached = self._attached.setdefault(position, set())
+            if place.get('place_id') in attached:
+                continue
+            attached.add(place.get('place_id'))
+            step.setdefault('accessible_places', []).append(place)
+            changed.add(position)
+        return changed
@@ -0,0 +1,300 @@
+"""
+Popularity-driven upkeep of the shared route and place caches.
+
+Every service process counts cache accesses with an AccessTracker and flushes the counts to the
+database. A RefreshScheduler then uses them to refresh the most used entries before they go stale and
+to drop entries nobody has used for a long time. It runs inside the service by default
+(REFRESH_SCHEDULER=true). With several service processes, turn it off there and run it once on its own:
+
+    REFRESH_SCHEDULER=false uvicorn app:app --workers 4
+    python refresh.py
+"""
+from datetime import timedelta
+from sqlalchemy import select, update, delete, bindparam, func, exists
+import asyncio
+import logging
+import time
+
+from models import CachedRoute, PlaceDetails, Route, utcnow
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+CACHE_REFRESHES = registry.counter(
+    'cache_refreshes', "Background refreshes of popular cache entries, by kind and outcome", ('kind', 'outcome'))
+CACHE_EVICTIONS = registry.counter('cache_evictions', "Cold cache entries deleted, by kind", ('kind',))
+CACHE_WARMED = registry.counter('cache_warmed', "Entries loaded into memory at startup, by kind", ('kind',))
+
+
+class AccessTracker:
+    """
+    Counts accesses to cached routes and places in memory and writes them to the database in batches,
+    so tracking costs a dictionary update per access rather than a write.
+    """
+    def __init__(self, session_factory, track_places=True, flush_interval=10.0):
+        self.session_factory = session_factory
+        self.track_places = track_places
+        self.flush_interval = flush_interval
+        self._routes = {}
+        self._places = {}
+        self._task = None
+
+    def route_accessed(self, route_id):
+        counts = self._routes.get(route_id)
+        if counts is None:
+            self._routes[route_id] = [1, utcnow()]
+        else:
+            counts[0] += 1
+            counts[1] = utcnow()
+
+    def place_accessed(self, place_id):
+        if not self.track_places:
+            return
+        counts = self._places.get(place_id)
+        if counts is None:
+            self._places[place_id] = [1, utcnow()]
+        else:
+            counts[0] += 1
+            counts[1] = utcnow()
+
+    async def flush(self):
+        routes, self._routes = self._routes, {}
+        places, self._places = self._places, {}
+        if not routes and not places:
+            return
+
+        async with self.session_factory() as db:
+            for table, key_column, counts in (
+                (CachedRoute.__table__, CachedRoute.__table__.c.id, routes),
+                (PlaceDetails.__table__, PlaceDetails.__table__.c.place_id, places),
+            ):
+                if not counts:
+                    continue
+                await db.execute(
+                    update(table)
+                    .where(key_column == bindparam('key'))
+                    .values(hit_count=table.c.hit_count + bindparam('hits'), last_accessed_at=bindparam('accessed_at')),
+                    [{"key": key, "hits": hits, "accessed_at": accessed_at} for key, (hits, accessed_at) in counts.items()]
+                )
+            await db.commit()
+
+    async def start(self):
+        self._task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Error flushing cache access counts")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Error flushing cache access counts")
+
+
+class RefreshScheduler:
+    """
+    Keeps popular cache entries fresh and drops cold ones, using the access counts in the database.
+
+    Every `interval` seconds, up to `batch_size` of the most used entries that expire within
+    `refresh_ahead` seconds are recomputed with `refresh_route(origin_key, destination_key, mode)` and
+    `refresh_place(place_id)`. Only entries used at least `min_hits` times, the latest within
+    `hot_window` seconds, count as popular. Every `evict_interval` seconds, expired entries nobody has
+    used for `evict_after` seconds are deleted. Route entries still listed in a user's history are kept.
+
+    warm_up() loads the most used entries into this process's memory with `warm_route(row)` and
+    `warm_place(row)`, which return whether there was room for the entry.
+    """
+    def __init__(self, session_factory, refresh_route, refresh_place=None, warm_route=None, warm_place=None,
+                 interval=60, refresh_ahead=600, hot_window=86400, min_hits=3, batch_size=50, concurrency=4,
+                 evict_after=2592000, evict_interval=3600):
+        self.session_factory = session_factory
+        self.refresh_route = refresh_route
+        self.refresh_place = refresh_place
+        self.warm_route = warm_route
+        self.warm_place = warm_place
+        self.interval = interval
+        self.refresh_ahead = refresh_ahead
+        self.hot_window = hot_window
+        self.min_hits = min_hits
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.evict_after = evict_after
+        self.evict_interval = evict_interval
+        self._last_eviction = time.monotonic()
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh_popular()
+                if time.monotonic() - self._last_eviction >= self.evict_interval:
+                    self._last_eviction = time.monotonic()
+                    await self.evict_cold()
+            except Exception:
+                logger.exception("Error refreshing caches")
+
+    async def _refresh_all(self, kind, refresh, keys):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(key):
+            async with semaphore:
+                try:
+                    outcome = await refresh(*key) or 'ok'
+                except Exception:
+                    logger.exception(f"Error refreshing {kind} {key}")
+                    outcome = 'error'
+            CACHE_REFRESHES.inc(kind=kind, outcome=outcome)
+            return outcome
+
+        return await asyncio.gather(*(run(key) for key in keys))
+
+    async def refresh_popular(self):
+        now = utcnow()
+        async with self.session_factory() as db:
+            routes = await db.execute(
+                select(CachedRoute.origin_key, CachedRoute.destination_key, CachedRoute.mode)
+                .filter(
+                    CachedRoute.expires_at <= now + timedelta(seconds=self.refresh_ahead),
+                    CachedRoute.last_accessed_at >= now - timedelta(seconds=self.hot_window),
+                    CachedRoute.hit_count >= self.min_hits
+                )
+                .order_by(CachedRoute.hit_count.desc())
+                .limit(self.batch_size)
+            )
+            routes = routes.all()
+
+            places = []
+            if self.refresh_place is not None:
+                places = await db.execute(
+                    select(PlaceDetails.place_id)
+                    .filter(
+                        PlaceDetails.expires_at <= now + timedelta(seconds=self.refresh_ahead),
+                        PlaceDetails.last_accessed_at >= now - timedelta(seconds=self.hot_window),
+                        PlaceDetails.hit_count >= self.min_hits
+                    )
+                    .order_by(PlaceDetails.hit_count.desc())
+                    .limit(self.batch_size)
+                )
+                places = places.all()
+
+        route_outcomes = await self._refresh_all('route', self.refresh_route, [tuple(row) for row in routes])
+        place_outcomes = await self._refresh_all('place', self.refresh_place, [tuple(row) for row in places])
+        if routes or places:
+            logger.info(f"Refreshed {route_outcomes.count('ok')}/{len(routes)} routes and "
+                        f"{place_outcomes.count('ok')}/{len(places)} places")
+        return route_outcomes, place_outcomes
+
+    async def evict_cold(self):
+        now = utcnow()
+        cold_before = now - timedelta(seconds=self.evict_after)
+        async with self.session_factory() as db:
+            routes = await db.execute(
+                delete(CachedRoute)
+                .where(
+                    CachedRoute.expires_at < now,
+                    func.coalesce(CachedRoute.last_accessed_at, CachedRoute.created_at) < cold_before,
+                    ~exists().where(Route.route_cache_id == CachedRoute.id)
+                )
+                .execution_options(synchronize_session=False)
+            )
+            places = await db.execute(
+                delete(PlaceDetails)
+                .where(
+                    PlaceDetails.expires_at < now,
+                    func.coalesce(PlaceDetails.last_accessed_at, PlaceDetails.fetched_at) < cold_before
+                )
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+
+        CACHE_EVICTIONS.inc(routes.rowcount, kind='route')
+        CACHE_EVICTIONS.inc(places.rowcount, kind='place')
+        if routes.rowcount or places.rowcount:
+            logger.info(f"Evicted {routes.rowcount} cold routes and {places.rowcount} cold places")
+        return routes.rowcount, places.rowcount
+
+    async def warm_up(self, max_seconds=10.0, max_bytes=64 * 1024 * 1024, batch_size=100):
+        """
+        Loads the most used unexpired routes, then places, into memory until either runs out, the
+        memory caches are full, `max_bytes` of payload have been loaded or `max_seconds` have passed.
+        """
+        deadline = time.monotonic() + max_seconds
+        loaded = {'route': 0, 'place': 0}
+        used_bytes = 0
+
+        sources = []
+        if self.warm_route is not None:
+            sources.append(('route', self.warm_route, select(
+                CachedRoute.id, CachedRoute.origin_key, CachedRoute.destination_key, CachedRoute.mode,
+                CachedRoute.expires_at, CachedRoute.degraded, CachedRoute.route_blob, CachedRoute.route_data
+            ).order_by(CachedRoute.hit_count.desc(), CachedRoute.id)))
+        if self.warm_place is not None:
+            sources.append(('place', self.warm_place, select(
+                PlaceDetails.place_id, PlaceDetails.details, PlaceDetails.expires_at
+            ).order_by(PlaceDetails.hit_count.desc(), PlaceDetails.place_id)))
+
+        for kind, warm, query in sources:
+            model = CachedRoute if kind == 'route' else PlaceDetails
+            offset = 0
+            while time.monotonic() < deadline and used_bytes < max_bytes:
+                async with self.session_factory() as db:
+                    rows = (await db.execute(
+                        query.filter(model.expires_at > utcnow()).offset(offset).limit(batch_size))).all()
+                if not rows:
+                    break
+                offset += len(rows)
+
+                full = False
+                for row in rows:
+                    size = sum(len(value) for value in row if isinstance(value, (bytes, str)))
+                    if used_bytes + size > max_bytes or not warm(row):
+                        full = True
+                        break
+                    used_bytes += size
+                    loaded[kind] += 1
+                if full:
+                    break
+
+        for kind, count in loaded.items():
+            CACHE_WARMED.inc(count, kind=kind)
+        logger.info(f"Warmed {loaded['route']} routes and {loaded['place']} places ({used_bytes} bytes)")
+        return loaded
+
+
+async def main():
+    import app
+
+    scheduler = app.create_refresh_scheduler()
+    logger.info("Refresh scheduler running")
+    await scheduler.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await scheduler.stop()
+        await app.close_google_client()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,230 @@
+from datetime import datetime, timezone
+import asyncio
+import time
+
+
+class UpstreamError(Exception):
+    """
+    An upstream call that was refused or gave up without a usable response.
+    """
+    pass
+
+
+class CircuitOpen(UpstreamError):
+    pass
+
+
+class RateLimited(UpstreamError):
+    pass
+
+
+class QuotaExhausted(UpstreamError):
+    pass
+
+
+class UpstreamUnavailable(UpstreamError):
+    pass
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller starts `fn()` as a task and later
+    callers await that same task until it finishes. Nothing is kept once it has; that is the job of
+    the caches in front of it.
+
+    Callers await the task through a shield, so one caller going away does not cancel the work for
+    the others.
+    """
+    def __init__(self):
+        self.started = 0
+        self.coalesced = 0
+        self._inflight = {}
+
+    async def do(self, key, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # every caller may have been cancelled; don't let asyncio report the exception as never retrieved
+        if not task.cancelled():
+            task.exception()
+
+    def __len__(self):
+        return len(self._inflight)
+
+
+class Batcher:
+    """
+    Coalesces calls for different keys into batches: submit(key, value) queues the key and waits for
+    `run({key: value, ...})`, which handles every key queued meanwhile and returns {key: result}. Keys
+    missing from its result get None; a key submitted again before its batch starts keeps the latest
+    value.
+
+    At most `semaphore`'s worth of batches run at once, of up to `max_batch` keys each. Keys queue up
+    while all slots are busy, so the busier it gets, the larger the batches. Like SingleFlight, callers
+    wait through a shield, so one going away does not fail the key for the others.
+    """
+    def __init__(self, run, semaphore, max_batch=500):
+        self.run = run
+        self.semaphore = semaphore
+        self.max_batch = max_batch
+        self.batches = 0
+        self._pending = {}
+        self._scheduled = False
+        self._tasks = set()
+
+    async def submit(self, key, value=None):
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = [value, asyncio.get_running_loop().create_future()]
+        else:
+            entry[0] = value
+        if not self._scheduled:
+            self._schedule()
+        return await asyncio.shield(entry[1])
+
+    def _schedule(self):
+        self._scheduled = True
+        task = asyncio.ensure_future(self._run_batch())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self):
+        async with self.semaphore:
+            # keys queued from here on wait for the next batch
+            self._scheduled = False
+            keys = list(self._pending)[:self.max_batch]
+            batch = {key: self._pending.pop(key) for key in keys}
+            if self._pending:
+                self._schedule()
+
+            self.batches += 1
+            try:
+                results = await self.run({key: value for key, (value, _) in batch.items()}) or {}
+            except asyncio.CancelledError:
+                for _, future in batch.values():
+                    future.cancel()
+                raise
+            except Exception as e:
+                for _, future in batch.values():
+                    if not future.done():
+                        future.set_exception(e)
+                        # every caller may have gone away; don't let asyncio report it as never retrieved
+                        future.exception()
+                return
+
+        for key, (_, future) in batch.items():
+            if not future.done():
+                future.set_result(results.get(key))
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average, in bursts of up to `burst`, and at most `daily_quota`
+    calls per UTC day. A rate or quota of 0 means no limit.
+
+    acquire() waits for a token, in arrival order, but raises RateLimited rather than wait longer than
+    `max_wait` seconds, and QuotaExhausted once the day's budget is spent.
+    """
+    def __init__(self, rate=0.0, burst=None, daily_quota=0, max_wait=10.0):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.daily_quota = daily_quota
+        self.max_wait = max_wait
+        self.tokens = self.burst
+        self.used_today = 0
+        self._updated = time.monotonic()
+        self._day = None
+        self._lock = asyncio.Lock()
+
+    def _charge_quota(self):
+        if not self.daily_quota:
+            return
+        today = datetime.now(timezone.utc).date()
+        if today != self._day:
+            self._day = today
+            self.used_today = 0
+        if self.used_today >= self.daily_quota:
+            raise QuotaExhausted(f"daily quota of {self.daily_quota} calls used")
+        self.used_today += 1
+
+    async def _take(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        if self.rate:
+            try:
+                await asyncio.wait_for(self._take(), timeout=self.max_wait)
+            except asyncio.TimeoutError:
+                raise RateLimited(f"no token within {self.max_wait}s at {self.rate} calls/s")
+        self._charge_quota()
+
+    def remaining_today(self):
+        if not self.daily_quota:
+            return None
+        if self._day != datetime.now(timezone.utc).date():
+            return self.daily_quota
+        return self.daily_quota - self.used_today
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing. After `failure_threshold` consecutive failures the
+    breaker opens and calls fail fast with CircuitOpen for `reset_timeout` seconds. Then a single trial
+    call is let through (half-open): success closes the breaker, failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_started = None
+
+    # raises CircuitOpen when the call should not be made
+    def allow(self):
+        if self.state == self.CLOSED:
+            return
+        now = time.monotonic()
+        if self.state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._trial_started = None
+        # a trial that never reported back (e.g. it was cancelled) is replaced after another reset_timeout
+        if self.state == self.HALF_OPEN and (self._trial_started is None
+                                             or now - self._trial_started >= self.reset_timeout):
+            self._trial_started = now
+            return
+        raise CircuitOpen(f"circuit open after {self.failures} consecutive failures")
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._trial_started = None
@@ -0,0 +1,73 @@
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# first byte of every stored blob; lets old rows stay readable when the default codec changes
+FORMAT_ZLIB = 1
+FORMAT_ZSTD = 2
+
+CODECS = {'zlib': FORMAT_ZLIB, 'zstd': FORMAT_ZSTD}
+
+
+def dumps_compact(value) -> bytes:
+    # same separators and escaping JSONResponse uses, so the bytes can be spliced into responses as-is
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def compress_json_bytes(raw: bytes, codec='zlib', level=6) -> bytes:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("ROUTE_CODEC=zstd requires the zstandard package")
+        return bytes([FORMAT_ZSTD]) + zstandard.ZstdCompressor(level=level).compress(raw)
+    return bytes([FORMAT_ZLIB]) + zlib.compress(raw, level)
+
+
+def decompress_json_bytes(blob: bytes) -> bytes:
+    version, body = blob[0], blob[1:]
+    if version == FORMAT_ZLIB:
+        return zlib.decompress(body)
+    if version == FORMAT_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Stored route uses zstd but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(body)
+    raise ValueError(f"Unknown route storage format: {version}")
+
+
+class RoutePayload:
+    """
+    A stored route payload that is only decompressed, and only parsed, when someone asks for it.
+
+    Built from a compressed blob, from a legacy plain-JSON `route_data` string, or from freshly
+    fetched routes. `json_bytes()` is enough to answer a request; `routes()` parses on top of that.
+    """
+    __slots__ = ('_blob', '_json', '_routes')
+
+    def __init__(self, blob=None, text=None, routes=None):
+        self._blob = blob
+        self._json = text.encode('utf-8') if text is not None else None
+        self._routes = routes
+
+    @classmethod
+    def from_routes(cls, routes):
+        payload = cls(routes=routes)
+        payload._json = dumps_compact(routes)
+        return payload
+
+    def json_bytes(self) -> bytes:
+        if self._json is None:
+            self._json = decompress_json_bytes(self._blob)
+        return self._json
+
+    def routes(self):
+        if self._routes is None:
+            self._routes = json.loads(self.json_bytes())
+        return self._routes
+
+    def blob(self, codec='zlib', level=6) -> bytes:
+        if self._blob is None:
+            self._blob = compress_json_bytes(self.json_bytes(), codec, level)
+        return self._blob
@@ -0,0 +1,156 @@
+from collections import Counter
+from contextlib import nullcontext
+import asyncio
+import httpx
+import random
+import time
+
+from metrics import UPSTREAM_REQUESTS, UPSTREAM_SECONDS, UPSTREAM_REJECTED, UPSTREAM_RETRIES, stage
+from resilience import (
+    UpstreamError, UpstreamUnavailable, CircuitOpen, RateLimited, QuotaExhausted, TokenBucket, CircuitBreaker
+)
+
+DEFAULT_BASE_URL = "https://maps.googleapis.com"
+
+APIS = ('directions', 'nearbysearch', 'details')
+
+# what callers catch to treat a Google call as failed, whether it failed on the wire or was refused here
+UPSTREAM_ERRORS = (httpx.HTTPError, UpstreamError)
+
+
+class GoogleMapsClient:
+    """
+    Interface for the Google Maps web services the service depends on. Each method returns the
+    decoded JSON body and raises one of UPSTREAM_ERRORS when no usable response could be had.
+
+    `limiter` is an optional async context manager (e.g. a per-request semaphore) held for the
+    duration of the call.
+    """
+    async def directions(self, origin, destination, mode, limiter=None):
+        raise NotImplementedError
+
+    async def nearby_search(self, lat, lng, radius, limiter=None):
+        raise NotImplementedError
+
+    async def place_details(self, place_id, fields, limiter=None):
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+
+class HttpGoogleMapsClient(GoogleMapsClient):
+    """
+    Talks to the Google Maps web services, or to anything serving the same paths at `base_url`
+    (such as fake_google.py), over one pooled keep-alive connection pool.
+
+    Each API has its own token bucket (`rate_limits` calls per second and `daily_quotas` calls per
+    day, 0 or missing for no limit) and circuit breaker. 5xx responses, timeouts, connection errors
+    and OVER_QUERY_LIMIT are retried `retries` times with jittered exponential backoff, and count
+    towards opening the breaker.
+    """
+    def __init__(self, api_key, base_url=DEFAULT_BASE_URL, max_connections=50, max_keepalive=20, timeout=10.0,
+                 transport=None, rate_limits=None, daily_quotas=None, max_wait=10.0, retries=2, backoff=0.2,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.api_key = api_key
+        self.calls = Counter()
+        self.retries = retries
+        self.backoff = backoff
+        self.buckets = {
+            api: TokenBucket(
+                rate=(rate_limits or {}).get(api, 0),
+                daily_quota=(daily_quotas or {}).get(api, 0),
+                max_wait=max_wait
+            )
+            for api in APIS
+        }
+        self.breakers = {api: CircuitBreaker(failure_threshold, reset_timeout) for api in APIS}
+        self.http = httpx.AsyncClient(
+            base_url=base_url,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive),
+            timeout=httpx.Timeout(timeout),
+            transport=transport,
+        )
+
+    async def _call(self, api, path, params, limiter):
+        self.calls[api] += 1
+        async with limiter or nullcontext():
+            with stage(f"google.{api}", histogram=None):
+                start = time.perf_counter()
+                outcome = 'error'
+                try:
+                    response = await self.http.get(path, params={**params, "key": self.api_key})
+                    response.raise_for_status()
+                    data = response.json()
+                    outcome = data.get('status', 'OK').lower()
+                    return data
+                except httpx.HTTPStatusError as e:
+                    outcome = f"http_{e.response.status_code}"
+                    raise
+                except httpx.TimeoutException:
+                    outcome = 'timeout'
+                    raise
+                finally:
+                    UPSTREAM_REQUESTS.inc(api=api, outcome=outcome)
+                    UPSTREAM_SECONDS.observe(time.perf_counter() - start, api=api, outcome=outcome)
+
+    async def _get(self, api, path, params, limiter):
+        breaker = self.breakers[api]
+        for attempt in range(self.retries + 1):
+            try:
+                breaker.allow()
+                await self.buckets[api].acquire()
+            except CircuitOpen:
+                UPSTREAM_REJECTED.inc(api=api, reason='circuit_open')
+                raise
+            except RateLimited:
+                UPSTREAM_REJECTED.inc(api=api, reason='rate_limit')
+                raise
+            except QuotaExhausted:
+                UPSTREAM_REJECTED.inc(api=api, reason='daily_quota')
+                raise
+
+            # httpx's messages carry the request URL, and with it the API key; don't pass them on
+            try:
+                data = await self._call(api, path, params, limiter)
+            except httpx.HTTPStatusError as e:
+                error = UpstreamUnavailable(f"{api}: HTTP {e.response.status_code}")
+                if e.response.status_code < 500:
+                    breaker.record_success()
+                    raise error from None
+            except httpx.TransportError as e:
+                error = UpstreamUnavailable(f"{api}: {type(e).__name__}")
+            else:
+                if data.get('status') != 'OVER_QUERY_LIMIT':
+                    breaker.record_success()
+                    return data
+                error = RateLimited(f"{api}: OVER_QUERY_LIMIT")
+
+            breaker.record_failure()
+            if attempt == self.retries:
+                raise error from None
+            UPSTREAM_RETRIES.inc(api=api)
+            await asyncio.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    async def directions(self, origin, destination, mode, limiter=None):
+        return await self._get('directions', "/maps/api/directions/json", {
+            "origin": origin,
+            "destination": destination,
+            "mode": mode,
+            "alternatives": "true",
+        }, limiter)
+
+    async def nearby_search(self, lat, lng, radius, limiter=None):
+        return await self._get('nearbysearch', "/maps/api/place/nearbysearch/json", {
+            "location": f"{lat},{lng}",
+            "radius": radius,
+        }, limiter)
+
+    async def place_details(self, place_id, fields, limiter=None):
+        return await self._get('details', "/maps/api/place/details/json", {
+            "place_id": place_id,
+            "fields": fields,
+        }, limiter)
+
+    async def aclose(self):
+        await self.http.aclose()